@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+NPC Generator benchmark
+----------------------------------------
+Times NPCGenerator start-up from the text files and from a compiled snapshot, the FeasibleSpace build, single
+generate() calls with and without selected parameters and large batches, with per-stage timings, tracemalloc
+allocations and NPCs/sec.
+Runs on the bundled database, on a synthetic copy with the Name and Race files scaled up and on a copy with many
+extra groups, and writes the results as JSON so versions can be compared (run with --help).
+----------------------------------------
+"""
+from __future__ import annotations
+
+import argparse
+import cProfile
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List, Optional, Dict
+
+import main
+from main import NPCGenerator, GenerationMetrics, InstrumentedContext, RARITY_PATTERN
+
+
+def scale_database(source_dir: str, target_dir: str, factor: int) -> None:
+    """
+    Copy a database folder with its Name and Race files scaled up factor times.
+    Every Name and Race parameter gets factor - 1 numbered copies with the same rarity, and every copied race
+    gets its own copies of the original race's Name and Sex subgroup files.
+    """
+    shutil.copytree(source_dir, target_dir)
+
+    def copies(item: str) -> List[str]:
+        rarity = RARITY_PATTERN.search(item)
+        base = item[:rarity.start()] if rarity else item
+        suffix = rarity.group(0) if rarity else ''
+        return [item] + [f"{base} {i}{suffix}" for i in range(2, factor + 1)]
+
+    def scale_file(path: str) -> None:
+        with open(path, encoding='utf-8') as f:
+            items = [line.strip() for line in f if line.strip()]
+        if items == ['None(N)'] or items == ['None']:
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(copy for item in items for copy in copies(item)) + '\n')
+
+    with open(os.path.join(source_dir, 'Race.txt'), encoding='utf-8') as f:
+        races = [RARITY_PATTERN.sub('', line.strip()) for line in f if line.strip()]
+
+    for group in ('Name', 'Race'):
+        scale_file(os.path.join(target_dir, f'{group}.txt'))
+        folder = os.path.join(target_dir, group)
+        for filename in os.listdir(folder):
+            if filename.endswith('.txt'):
+                scale_file(os.path.join(folder, filename))
+
+    for group in ('Name', 'Sex'):
+        folder = os.path.join(target_dir, group)
+        source_folder = os.path.join(source_dir, group)
+        for race in races:
+            for variant in dict.fromkeys((race, race.replace(' ', '_'))):
+                source = os.path.join(source_folder, f'{variant}{group}.txt')
+                if not os.path.isfile(source):
+                    continue
+                for i in range(2, factor + 1):
+                    shutil.copyfile(source, os.path.join(folder, f'{variant}_{i}{group}.txt'))
+
+
+def add_groups(database_dir: str, config: str, count: int) -> str:
+    """
+    Add count synthetic groups of 50 parameters each to a database folder and return the config extended for them.
+    Every third synthetic group is also made optional and every fourth multiple.
+    """
+    rarities = ['', '(C)', '(U)', '(R)', '(M)']
+    optional, multiple = [], []
+    for i in range(1, count + 1):
+        group = f'Synthetic{i:03}'
+        with open(os.path.join(database_dir, f'{group}.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(f'{group} parameter {j}{rarities[j % len(rarities)]}' for j in range(50)) + '\n')
+        if i % 3 == 0:
+            optional.append(f'{group}_by_60')
+        if i % 4 == 0:
+            multiple.append(f'{group}_by_30_min1max3')
+
+    def extend(text: str, heading: str, rules: List[str]) -> str:
+        start = text.index(f'__{heading}__\n')
+        end = text.index('/end', start)
+        section = text[start:end].replace('\nNone\n', '\n')
+        return text[:start] + section + ''.join(rule + '\n' for rule in rules) + text[end:]
+
+    return extend(extend(config, 'OptionalGroup', optional), 'MultipleGroup', multiple)
+
+
+def constrained_params(npc_gen: NPCGenerator) -> Dict[str, Dict[str, str]]:
+    """Selected parameters for every benchmarked scenario, taken from the loaded database."""
+
+    def first(group: str) -> Optional[str]:
+        params = [RARITY_PATTERN.sub('', p).strip() for p in npc_gen.extract_list(None, group)]
+        return next((p for p in params if p != 'None'), None)
+
+    scenarios = {'unconstrained': {}}
+    nationality = first('Nationality')
+    if nationality:
+        scenarios['nationality'] = {'Nationality': nationality}
+    race = first('Race')
+    if race:
+        scenarios['race'] = {'Race': race}
+    religion = first('Religion')
+    if religion:
+        scenarios['religion'] = {'Religion': religion}
+    scenarios['all_any'] = {group: 'Any' for group in main.SELECTABLE_GROUPS if group in npc_gen.all_groups}
+    return scenarios
+
+
+def bench_init(config_file: str, database_dir: str, repeat: int) -> Dict[str, float]:
+    """Time NPCGenerator construction, which reads and compiles the config and database."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        NPCGenerator(config_file, database_dir)
+        timings.append(time.perf_counter() - start)
+    return _timings(timings)
+
+
+def _timings(timings: List[float]) -> Dict[str, float]:
+    return {'best_ms': min(timings) * 1000, 'mean_ms': sum(timings) / len(timings) * 1000}
+
+
+COLD_START_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import main
+npc_gen = main.NPCGenerator(sys.argv[1], sys.argv[2], snapshot_file=sys.argv[3] or None)
+npc_gen.generate()
+print(time.perf_counter() - start)
+"""
+
+
+def bench_cold_start(config_file: str, database_dir: str, repeat: int) -> Dict[str, Dict[str, float]]:
+    """
+    Time a fresh process importing main, loading the data and generating its first NPC,
+    from the text files and from a compiled snapshot file, plus an in-process load of the snapshot.
+    """
+    package_dir = os.path.dirname(os.path.abspath(main.__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_dir, os.environ.get('PYTHONPATH')])))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_file = os.path.join(tmp, 'npc.snapshot')
+        start = time.perf_counter()
+        main.compile_snapshot(config_file, database_dir, snapshot_file)
+        results['compile'] = _timings([time.perf_counter() - start])
+        for loader, path in (('text', ''), ('snapshot', snapshot_file)):
+            timings = []
+            for _ in range(repeat):
+                output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT, config_file, database_dir, path],
+                                        env=env, check=True, capture_output=True, text=True).stdout
+                timings.append(float(output.split()[-1]))
+            results[loader] = _timings(timings)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            NPCGenerator(config_file, database_dir, snapshot_file=snapshot_file).snapshot
+            timings.append(time.perf_counter() - start)
+        results['snapshot_init'] = _timings(timings)
+    return results
+
+
+def bench_feasible(config_file: str, database_dir: str, repeat: int) -> Dict[str, object]:
+    """
+    Time building the FeasibleSpace of a freshly loaded generator, then the first count over every combination,
+    which reads the name pools the build leaves out.
+    """
+    builds, counts = [], []
+    for _ in range(repeat):
+        snapshot = NPCGenerator(config_file, database_dir).snapshot
+        start = time.perf_counter()
+        feasible = snapshot.feasible
+        builds.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        count = feasible.count({})
+        counts.append(time.perf_counter() - start)
+    return {'build': _timings(builds), 'first_count': _timings(counts), 'combinations': count,
+            'candidates': len(feasible.combinations)}
+
+
+def bench_single(npc_gen: NPCGenerator, selected_params: Dict[str, str], n: int, seed: int) -> Dict[str, object]:
+    """Time n separate generate() calls, splitting each call into its stages."""
+    rng = random.Random(seed)
+    metrics = GenerationMetrics()
+    start = time.perf_counter()
+    for _ in range(n):
+        ctx = InstrumentedContext(metrics, npc_gen.snapshot, rng)
+        steps = ctx.snapshot.resolve_selected_params(selected_params)
+        if steps is not None:
+            ctx.generate(steps, selected_params)
+    elapsed = time.perf_counter() - start
+    result = {'count': n, 'seconds': elapsed, 'npcs_per_sec': n / elapsed}
+    stages = metrics.stage_seconds
+    result['stages_us_per_npc'] = {stage: seconds / n * 1e6 for stage, seconds in stages.items()}
+    result['stages_us_per_npc']['other'] = (elapsed - sum(stages.values())) / n * 1e6
+    return result
+
+
+def bench_batch(npc_gen: NPCGenerator, selected_params: Dict[str, str], n: int, seed: int) -> Dict[str, object]:
+    """Time generate_many() over a batch of n NPCs."""
+    start = time.perf_counter()
+    for _ in npc_gen.generate_many(n, selected_params, rng=random.Random(seed)):
+        pass
+    elapsed = time.perf_counter() - start
+    return {'count': n, 'seconds': elapsed, 'npcs_per_sec': n / elapsed}
+
+
+def bench_memory(npc_gen: NPCGenerator, selected_params: Dict[str, str], n: int, seed: int,
+                 top: int = 5) -> Dict[str, object]:
+    """Trace allocations of a generate_many() batch of n NPCs that are kept in memory."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        npcs = list(npc_gen.generate_many(n, selected_params, rng=random.Random(seed)))
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'lineno')
+    return {
+        'count': len(npcs),
+        'peak_kib': peak / 1024,
+        'retained_bytes_per_npc': sum(s.size_diff for s in stats) / max(len(npcs), 1),
+        'retained_blocks_per_npc': sum(s.count_diff for s in stats) / max(len(npcs), 1),
+        'top_sites': [{'site': str(s.traceback), 'size_kib': s.size_diff / 1024, 'blocks': s.count_diff}
+                      for s in stats[:top]],
+    }
+
+
+def profile_batch(npc_gen: NPCGenerator, n: int, seed: int, path: str) -> None:
+    """Profile an unconstrained generate_many() batch of n NPCs and save the stats for pstats or snakeviz."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for _ in npc_gen.generate_many(n, rng=random.Random(seed)):
+        pass
+    profiler.disable()
+    profiler.dump_stats(path)
+
+
+def run_suite(name: str, config_file: str, database_dir: str, args: argparse.Namespace) -> Dict[str, object]:
+    """Run every benchmark against one database."""
+    print(f"[{name}] init", file=sys.stderr)
+    suite = {'database': database_dir, 'init': bench_init(config_file, database_dir, args.repeat)}
+    suite['cold_start'] = bench_cold_start(config_file, database_dir, args.repeat)
+    print(f"[{name}] feasible", file=sys.stderr)
+    suite['feasible'] = bench_feasible(config_file, database_dir, args.repeat)
+    cache_bytes = int(args.cache_mb * (1 << 20)) if args.cache_mb is not None else None
+    npc_gen = NPCGenerator(config_file, database_dir, seed=args.seed, cache_bytes=cache_bytes)
+    suite['single'] = {}
+    suite['batch'] = {}
+    for scenario, selected_params in constrained_params(npc_gen).items():
+        print(f"[{name}] {scenario}", file=sys.stderr)
+        suite['single'][scenario] = dict(bench_single(npc_gen, selected_params, args.single, args.seed),
+                                         selected_params=selected_params)
+        suite['batch'][scenario] = bench_batch(npc_gen, selected_params, args.batch, args.seed)
+    suite['memory'] = bench_memory(npc_gen, {}, args.memory, args.seed)
+    if args.profile:
+        suite['profile'] = f"{args.profile}.{name}.prof"
+        profile_batch(npc_gen, args.batch, args.seed, suite['profile'])
+    suite['cache'] = npc_gen.cache_stats()
+    return suite
+
+
+def compare(results: Dict[str, object], baseline: Dict[str, object], tolerance: float) -> List[str]:
+    """List every NPCs/sec figure that dropped more than tolerance below the baseline."""
+    regressions = []
+    for name, suite in results['suites'].items():
+        for kind in ('single', 'batch'):
+            for scenario, result in suite[kind].items():
+                try:
+                    old = baseline['suites'][name][kind][scenario]['npcs_per_sec']
+                except KeyError:
+                    continue
+                if result['npcs_per_sec'] < old * (1 - tolerance):
+                    regressions.append(f"{name}/{kind}/{scenario}: {result['npcs_per_sec']:.0f} NPCs/sec "
+                                       f"against {old:.0f} NPCs/sec")
+    return regressions
+
+
+def print_summary(results: Dict[str, object]) -> None:
+    """Print a readable table of the results."""
+    for name, suite in results['suites'].items():
+        print(f"== {name} ({suite['database']})")
+        cold = suite['cold_start']
+        print(f"init: {suite['init']['best_ms']:.1f} ms best, {suite['init']['mean_ms']:.1f} ms mean, "
+              f"from snapshot {cold['snapshot_init']['best_ms']:.1f} ms best")
+        print(f"cold start to first NPC: text {cold['text']['best_ms']:.1f} ms, "
+              f"snapshot {cold['snapshot']['best_ms']:.1f} ms best (compile {cold['compile']['best_ms']:.1f} ms)")
+        feasible = suite['feasible']
+        print(f"feasible space: build {feasible['build']['best_ms']:.1f} ms, first count "
+              f"{feasible['first_count']['best_ms']:.1f} ms best ({feasible['combinations']} of "
+              f"{feasible['candidates']} combinations named)")
+        for scenario, result in suite['single'].items():
+            stages = ', '.join(f"{stage} {us:.0f}" for stage, us in result['stages_us_per_npc'].items())
+            print(f"single {scenario:<14} {result['npcs_per_sec']:>9.0f} NPCs/sec  (us/NPC: {stages})")
+        for scenario, result in suite['batch'].items():
+            print(f"batch  {scenario:<14} {result['npcs_per_sec']:>9.0f} NPCs/sec")
+        memory = suite['memory']
+        print(f"memory: peak {memory['peak_kib']:.0f} KiB for {memory['count']} NPCs, "
+              f"{memory['retained_bytes_per_npc']:.0f} bytes and {memory['retained_blocks_per_npc']:.1f} "
+              f"blocks retained per NPC")
+        cache = suite['cache']
+        print(f"subgroup cache: {cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions, "
+              f"{cache['entries']} entries in {cache['bytes'] / 1024:.0f} of {cache['max_bytes'] / 1024:.0f} KiB")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse benchmark options."""
+    parser = argparse.ArgumentParser(description="NPC Generator benchmark")
+    parser.add_argument('--config', default="./config.txt", help="path to config.txt")
+    parser.add_argument('--database', default="./database", help="path to the database folder")
+    parser.add_argument('--scale', type=int, default=100,
+                        help="scale factor of the synthetic database, 0 or 1 skips it (default: 100)")
+    parser.add_argument('--groups', type=int, default=60,
+                        help="synthetic groups added for the many-group suite, 0 skips it (default: 60)")
+    parser.add_argument('--single', type=int, default=500, help="generate() calls per scenario")
+    parser.add_argument('--batch', type=int, default=5000, help="NPCs per generate_many() batch")
+    parser.add_argument('--memory', type=int, default=1000, help="NPCs traced with tracemalloc")
+    parser.add_argument('--repeat', type=int, default=3, help="timed NPCGenerator constructions")
+    parser.add_argument('--seed', type=int, default=0, help="seed of every benchmark RNG")
+    parser.add_argument('--cache-mb', type=float, help="subgroup cache bound of the benchmarked generators in MiB")
+    parser.add_argument('--output', help="file to write JSON results to")
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help="also save cProfile stats of a batch to PREFIX.<suite>.prof")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed NPCs/sec drop against --compare before failing (default: 0.2)")
+    return parser.parse_args(argv)
+
+
+def main_benchmark(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmark suites, print and save the results; returns 1 if a regression was found."""
+    args = parse_args(argv)
+    version = re.search(r'Cod version: (\S+)', main.__doc__ or '')
+    results = {
+        'version': version.group(1) if version else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'profile')},
+        'suites': {},
+    }
+    results['suites']['bundled'] = run_suite('bundled', args.config, args.database, args)
+    if args.scale > 1:
+        with tempfile.TemporaryDirectory() as tmp:
+            scaled_dir = os.path.join(tmp, 'database')
+            scale_database(args.database, scaled_dir, args.scale)
+            results['suites'][f'scaled_x{args.scale}'] = run_suite(f'scaled_x{args.scale}', args.config,
+                                                                   scaled_dir, args)
+    if args.groups > 0:
+        with tempfile.TemporaryDirectory() as tmp:
+            groups_dir = os.path.join(tmp, 'database')
+            shutil.copytree(args.database, groups_dir)
+            with open(args.config, encoding='utf-8') as f:
+                config = add_groups(groups_dir, f.read(), args.groups)
+            groups_config = os.path.join(tmp, 'config.txt')
+            with open(groups_config, 'w', encoding='utf-8') as f:
+                f.write(config)
+            results['suites'][f'groups_{args.groups}'] = run_suite(f'groups_{args.groups}', groups_config,
+                                                                   groups_dir, args)
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
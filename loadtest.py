@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+NPC Generator HTTP service load test
+----------------------------------------
+Sends POST /generate requests to a running server.py from concurrent keep-alive connections and reports
+latency percentiles, requests/sec and NPCs/sec. With --start-server a local server is started for the run
+(run with --help).
+----------------------------------------
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str], bytes]:
+    """Read one HTTP/1.1 response with a Content-Length or chunked body."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("server closed the connection")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            data = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            body.append(data[:-2])
+        return status, headers, b''.join(body)
+    return status, headers, await reader.readexactly(int(headers.get('content-length', 0)))
+
+
+def count_npcs(headers: Dict[str, str], body: bytes) -> int:
+    """Number of NPCs in a JSON or JSON Lines /generate response."""
+    if headers.get('content-type') == 'application/x-ndjson':
+        return body.count(b'\n')
+    return len(json.loads(body).get('npcs', ()))
+
+
+async def worker(host: str, port: int, request: bytes, deadline: float, remaining: List[int],
+                 latencies: List[float], statuses: Dict[int, int], npcs: List[int]) -> None:
+    """Send requests over one connection until the request budget or the duration is used up."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while remaining[0] > 0 and time.perf_counter() < deadline:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            writer.write(request)
+            try:
+                status, headers, body = await read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                statuses[0] = statuses.get(0, 0) + 1
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                npcs[0] += count_npcs(headers, body)
+    finally:
+        writer.close()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float('nan')
+
+
+async def run(args: argparse.Namespace, host: str, port: int) -> dict:
+    payload = {'selected_params': dict(item.split('=', 1) for item in args.param), 'count': args.count}
+    body = json.dumps(payload).encode()
+    request = (f"POST /generate HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    npcs = [0]
+    budgets = [args.requests // args.concurrency + (i < args.requests % args.concurrency)
+               for i in range(args.concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(host, port, request, start + args.duration, [budget], latencies, statuses, npcs)
+                           for budget in budgets))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'npcs_per_sec': npcs[0] / elapsed,
+        'latency_ms': {'p50': percentile(latencies, 0.50) * 1000, 'p90': percentile(latencies, 0.90) * 1000,
+                       'p99': percentile(latencies, 0.99) * 1000, 'max': max(latencies, default=0) * 1000},
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+    }
+
+
+def start_server(server_args: List[str]) -> Tuple[subprocess.Popen, int]:
+    """Start server.py on a free port and wait until it listens."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    process = subprocess.Popen([sys.executable, script, '--port', '0'] + server_args, stderr=subprocess.PIPE, text=True)
+    line = process.stderr.readline()
+    match = re.search(r':(\d+)\s*$', line)
+    if not match:
+        process.kill()
+        raise SystemExit(f"error: server did not start: {line.strip()}")
+    return process, int(match.group(1))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="NPC Generator HTTP service load test")
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help="server address (default: %(default)s)")
+    parser.add_argument('--start-server', action='store_true', help="start a local server.py for the run")
+    parser.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                        help="extra argument for the started server, can be repeated")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent connections (default: 16)")
+    parser.add_argument('--requests', type=int, default=2000, help="total requests to send (default: 2000)")
+    parser.add_argument('--duration', type=float, default=60.0, help="stop sending after this many seconds")
+    parser.add_argument('--count', type=int, default=1, help="NPCs asked for per request (default: 1)")
+    parser.add_argument('--param', action='append', default=[], metavar='GROUP=VALUE',
+                        help="selected parameter sent with every request, can be repeated")
+    parser.add_argument('--output', help="file to write JSON results to")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    url = urlsplit(args.url)
+    host, port = url.hostname or '127.0.0.1', url.port or 80
+    process = None
+    if args.start_server:
+        process, port = start_server(args.server_arg)
+    try:
+        results = asyncio.run(run(args, host, port))
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    latency = results['latency_ms']
+    print(f"{results['requests']} requests in {results['seconds']:.2f} s: {results['requests_per_sec']:.0f} req/s, "
+          f"{results['npcs_per_sec']:.0f} NPCs/s")
+    print(f"latency p50 {latency['p50']:.2f} ms, p90 {latency['p90']:.2f} ms, p99 {latency['p99']:.2f} ms, "
+          f"max {latency['max']:.2f} ms")
+    print(f"statuses: {results['statuses']}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,31 +6,572 @@ Cod version: v.0.0.8
 Generates NPCs from a database stored in individual files within a folder structure.
 Includes a Tkinter GUI with options to select parameters for all groups except Name and Personalities.
 Streamlined Nationality handling to integrate with other parameters.
+Headless bulk generation from the command line as text, JSON Lines, CSV or SQLite (run with --help).
+Saved NPCs are appended in batches as text, JSON Lines or an indexed SQLite database (NPCStore, --save).
+Config and database can be compiled into a binary snapshot for a faster start (--compile, --snapshot).
+Edited config and database files can be reloaded while the generator runs (NPCGenerator.watch, --watch).
+A seed, the snapshot version and the selected parameters regenerate an NPC exactly (NPCGenerator.replay).
+Name, Race and Sex subgroup files are read on first use and kept in a memory bounded LRU cache (--cache-mb).
 ----------------------------------------
 First update: 2024-02-29
 First programmer: Martin Martinic
 Last update: 2025-08-03
 Last programmer: Roko
 """
-
+from __future__ import annotations
+
+import argparse
+import collections
+import copy
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
+import queue
 import random
 import re
-import tkinter as tk
-from tkinter import ttk, scrolledtext
-from typing import List, Tuple, Optional, Union, Dict
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import weakref
+from typing import List, Tuple, Optional, Union, Dict, FrozenSet, Set, Iterator, Iterable, TextIO
+
+try:
+    import tkinter as tk
+    from tkinter import ttk, scrolledtext
+except ImportError:  # headless installs can still generate from the command line
+    tk = ttk = scrolledtext = None
 
 import unicodedata
 
+try:
+    import fcntl
+except ImportError:  # no advisory file locks on Windows, saves are then only serialized within the process
+    fcntl = None
 
-class NPCGenerator:
-    """Generates Non-Playable Characters (NPCs) based on configuration and database files."""
 
-    def __init__(self, config_file: str = "./config.txt", database_dir: str = "./database"):
-        """Initialize NPC generator with configuration and database folder."""
+RARITY_PATTERN = re.compile(r'\(\w{1,3}\)$')
+SUBGROUP_CACHE_BYTES = 64 << 20
+GUI_BATCH_CHUNK = 64
+GUI_BATCH_SHOWN = 1000
+GUI_POLL_MS = 50
+UNIQUE_KEY = ('Name', 'Race', 'Nationality')
+UNIQUE_EXACT_LIMIT = 1_000_000
+
+
+def _display_form(param: str) -> str:
+    """Interned display form of a parameter, without rarity suffix and underscores."""
+    return sys.intern(RARITY_PATTERN.sub('', param).replace('_', ' ').strip())
+
+
+class GroupEntries:
+    """Parameters of a single database file, normalized and split from their rarity suffixes."""
+
+    __slots__ = ('items', 'bases', 'rarities', 'displays', '__weakref__')
+
+    def __init__(self, items: Tuple[str, ...]):
+        self.items = items
+        self.bases = tuple(RARITY_PATTERN.sub('', item) for item in items)
+        self.rarities = tuple(self._rarity_of(item) for item in items)
+        self.displays = tuple(map(_display_form, items))
+
+    @staticmethod
+    def _rarity_of(item: str) -> str:
+        match = RARITY_PATTERN.search(item)
+        return match.group(0)[1:-1] if match else ''
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the entries, counting strings shared with the items once."""
+        size = sys.getsizeof(self.items) * 4 + sum(map(sys.getsizeof, self.items))
+        size += sum(sys.getsizeof(base) for base, item in zip(self.bases, self.items) if base is not item)
+        return size + sum(sys.getsizeof(display) for display, item in zip(self.displays, self.items)
+                          if display != item)
+
+
+class RarityTable:
+    """Parameters of one list with the inclusion probability of each parameter resolved from its rarity class."""
+
+    __slots__ = ('items', 'bases', 'probabilities')
+
+    def __init__(self, entries: GroupEntries, probabilities: List[float]):
+        self.items = entries.items
+        self.bases = entries.bases
+        self.probabilities = tuple(probabilities)
+
+
+class RaritySampler:
+    """
+    Draws parameters from precomputed per-list rarity tables.
+    A parameter passes its rarity roll with probability (rarity / 100), the same odds as 'rarity >= randint(1, 100)'.
+    Parameter selection uses draw(), which rolls rarity only for the parameters it visits.
+    The sampler holds no random state of its own.
+    Tables of indexed entries are kept only as long as their entries, so subgroups evicted from the
+    SubgroupCache take their tables with them; tables are not pickled and are rebuilt on first use.
+    """
+
+    def __init__(self, rarity_classes: Dict[str, int]):
+        self.rarity_probabilities = dict(rarity_classes)
+        self.tables: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.list_tables: Dict[Tuple[str, ...], RarityTable] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {'rarity_probabilities': self.rarity_probabilities, 'list_tables': self.list_tables}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__({})
+        self.__dict__.update(state)
+
+    def copy(self) -> 'RaritySampler':
+        """Sampler with the same rarity classes, starting with the tables built so far."""
+        sampler = RaritySampler({})
+        sampler.rarity_probabilities = self.rarity_probabilities
+        with self._lock:
+            sampler.tables.update(self.tables)
+            sampler.list_tables.update(self.list_tables)
+        return sampler
+
+    def probability(self, rarity_class: str) -> float:
+        """Chance of a parameter with the given rarity class being in the choosing pool."""
+        prob = self.rarity_probabilities.get(rarity_class)
+        if prob is None:
+            prob = int(rarity_class) if rarity_class.isdigit() else 100
+        return min(max(prob, 0), 100) / 100
+
+    def table(self, key: Union[GroupEntries, Tuple[str, ...]]) -> RarityTable:
+        """Return the cached rarity table for indexed entries or a raw parameter tuple, building it on first use."""
+        tables = self.list_tables if isinstance(key, tuple) else self.tables
+        table = tables.get(key)
+        if table is None:
+            entries = key if isinstance(key, GroupEntries) else GroupEntries(key)
+            table = RarityTable(entries, [self.probability(r) for r in entries.rarities])
+            with self._lock:
+                tables[key] = table
+        return table
+
+    @staticmethod
+    def draw(table: RarityTable, k: int, ctx: 'GenerationContext') -> List[str]:
+        """
+        Draw k parameters in one pass, as if the list were filtered by rarity and k distinct survivors were
+        then picked uniformly. The list is walked in a lazily shuffled order (a sparse Fisher-Yates) and every
+        visited parameter gets its rarity roll; the walk stops as soon as k parameters pass, so a short pick
+        from a long list costs O(k) instead of O(len(list)). Once every survivor is used, the remaining
+        picks repeat survivors uniformly. Returns [] if no parameter survives.
+        """
+        rng = ctx.rng
+        probabilities = table.probabilities
+        picks = []
+        swapped: Dict[int, int] = {}
+        n = len(probabilities)
+        visited = 0
+        for i in range(n):
+            if len(picks) == k:
+                break
+            visited += 1
+            j = rng.randrange(i, n)
+            current = swapped.get(j, j)
+            swapped[j] = swapped.get(i, i)
+            if rng.random() < probabilities[current]:
+                picks.append(current)
+        if ctx.instrumented:
+            ctx.count('draws')
+            ctx.count('draw_rejections', visited - len(picks))
+            if len(picks) < k:
+                ctx.count('draw_exhausted')
+        if not picks:
+            return []
+        survivors = len(picks)
+        while len(picks) < k:
+            picks.append(picks[rng.randrange(survivors)])
+        return [table.bases[i] for i in picks]
+
+    @staticmethod
+    def choice(table: RarityTable, ctx: 'GenerationContext') -> str:
+        """Pick one parameter of a list ignoring rarity, with its rarity suffix removed."""
+        return ctx.rng.choice(table.bases)
+
+
+class SubgroupCache:
+    """
+    Parsed subgroup files and merged name pools of one DatabaseIndex, evicted least recently used first once
+    their estimated memory exceeds max_bytes. Safe to share between threads; counts hits, misses and evictions.
+    Pickles empty, so snapshot files and worker processes fill their own cache on use.
+    """
+
+    def __init__(self, max_bytes: int = SUBGROUP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: collections.OrderedDict = collections.OrderedDict()  # key -> (GroupEntries, nbytes)
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['max_bytes'])
+
+    def get(self, key: tuple) -> Optional[GroupEntries]:
+        """Cached entries for the key, marked as most recently used, or None after counting a miss."""
+        with self._lock:
+            cached = self.entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+
+    def put(self, key: tuple, entries: GroupEntries) -> GroupEntries:
+        """Cache entries loaded after a miss; returns the cached entries if another thread loaded them first."""
+        nbytes = entries.nbytes()
+        with self._lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                return cached[0]
+            self.entries[key] = (entries, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return entries
+
+    def _evict(self) -> None:
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes: int) -> None:
+        """Change the memory bound, evicting at once if the cache is over it."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def copy(self, drop=lambda key: False) -> 'SubgroupCache':
+        """Cache sharing the cached entries, except those whose key drop() is true for, and the statistics."""
+        cache = SubgroupCache(self.max_bytes)
+        with self._lock:
+            cache.entries.update((key, cached) for key, cached in self.entries.items() if not drop(key))
+            cache.hits, cache.misses, cache.evictions = self.hits, self.misses, self.evictions
+        cache.nbytes = sum(nbytes for _, nbytes in cache.entries.values())
+        return cache
+
+    def stats(self) -> Dict[str, int]:
+        """Hit, miss and eviction counts with the number and estimated bytes of cached entries."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+class SubgroupStore:
+    """
+    Subgroup files of one group subfolder, such as Name. Only the file names are listed up front;
+    a file is read and parsed on first use and its entries are kept in the index's SubgroupCache.
+    """
+
+    __slots__ = ('folder', 'path', 'files', 'cache')
+
+    def __init__(self, folder: str, path: str, cache: SubgroupCache, files: Optional[Dict[str, str]] = None):
+        self.folder = folder
+        self.path = path
+        self.cache = cache
+        if files is None:
+            files = {unicodedata.normalize('NFC', f[:-4]): f for f in os.listdir(path) if f.endswith('.txt')}
+        self.files = files
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.files
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def get(self, name: str, default: Optional[GroupEntries] = None) -> Optional[GroupEntries]:
+        """Entries of a subgroup file, from the cache or read and cached now."""
+        if name not in self.files:
+            return default
+        key = (self.folder, name)
+        entries = self.cache.get(key)
+        if entries is None:
+            entries = self.cache.put(key, self.read(name))
+        return entries
+
+    def read(self, name: str) -> GroupEntries:
+        """Parse a subgroup file without touching the cache."""
+        with open(os.path.join(self.path, self.files[name]), encoding='utf-8') as f:
+            return DatabaseIndex._parse(f.read())
+
+    def copy(self, cache: SubgroupCache) -> 'SubgroupStore':
+        return SubgroupStore(self.folder, self.path, cache, dict(self.files))
+
+
+class DatabaseIndex:
+    """
+    In-memory index of every group file and the subgroup files of every group subfolder, built with a single
+    walk of the database folder. Group files are parsed up front; subgroup files, which grow with every race
+    and culture, are SubgroupStores that read a file on first use and keep at most cache_bytes of them.
+    """
+
+    SUBFOLDERS = ('Name', 'Race', 'Sex')
+    NAME_POOLS = ''  # cache key prefix of the merged name pools DatabaseSnapshot.name_pool() builds
+
+    def __init__(self, database_dir: str, cache_bytes: int = SUBGROUP_CACHE_BYTES):
         self.database_dir = database_dir
-        self._load_config(config_file)
-        self._load_database()
+        self.texts: Dict[str, str] = {}
+        self.groups: Dict[str, GroupEntries] = {}
+        self.cache = SubgroupCache(cache_bytes)
+        self.subgroups: Dict[str, SubgroupStore] = {}
+        self._resolved: Dict[str, Optional[Tuple[str, str]]] = {}
+        self._build()
+
+    @staticmethod
+    def _parse(text: str) -> GroupEntries:
+        items = text.strip().split('\n')
+        return GroupEntries(tuple(unicodedata.normalize('NFC', item.strip()) for item in items if item.strip()))
+
+    def _read_folder(self, folder: str) -> Dict[str, str]:
+        texts = {}
+        for filename in os.listdir(folder):
+            if filename.endswith('.txt'):
+                with open(os.path.join(folder, filename), encoding='utf-8') as f:
+                    texts[unicodedata.normalize('NFC', filename[:-4])] = f.read()
+        return texts
+
+    def _build(self) -> None:
+        """Read and parse the top level group files and list the files of every group subfolder."""
+        try:
+            self.texts = self._read_folder(self.database_dir)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Database directory {self.database_dir} not found.")
+        self.groups = {name: self._parse(text) for name, text in self.texts.items()}
+        for folder in dict.fromkeys(list(self.SUBFOLDERS) + list(self.groups)):
+            folder_path = os.path.join(self.database_dir, folder)
+            if os.path.isdir(folder_path):
+                self.subgroups[folder] = SubgroupStore(folder, folder_path, self.cache)
+
+    def updated(self, paths: Iterable[str]) -> Tuple['DatabaseIndex', Set[str]]:
+        """
+        New index with the given group files re-read, added or dropped, sharing every other parsed file.
+        Returns the index and the names of the groups and group subfolders that changed.
+        """
+        index = copy.copy(self)
+        index.texts = dict(self.texts)
+        index.groups = dict(self.groups)
+        index.subgroups = {folder: store.copy(self.cache) for folder, store in self.subgroups.items()}
+        index._resolved = {}
+        changed = set()
+        changed_files = set()
+        for path in paths:
+            folder, filename = os.path.split(os.path.relpath(path, self.database_dir))
+            if not filename.endswith('.txt') or os.sep in folder:
+                continue
+            name = unicodedata.normalize('NFC', filename[:-4])
+            text = None
+            if os.path.isfile(path):
+                with open(path, encoding='utf-8') as f:
+                    text = f.read()
+            if not folder:
+                changed.add(name)
+                if text is None:
+                    index.texts.pop(name, None)
+                    index.groups.pop(name, None)
+                else:
+                    index.texts[name] = text
+                    index.groups[name] = self._parse(text)
+                    folder_path = os.path.join(self.database_dir, name)
+                    if name not in index.subgroups and os.path.isdir(folder_path):
+                        index.subgroups[name] = SubgroupStore(name, folder_path, self.cache)
+            elif folder in self.SUBFOLDERS or folder in index.groups:
+                changed.add(folder)
+                changed_files.add((folder, name))
+                store = index.subgroups.get(folder)
+                if store is None:
+                    store = index.subgroups[folder] = SubgroupStore(folder, os.path.join(self.database_dir, folder),
+                                                                    self.cache, {})
+                if text is None:
+                    store.files.pop(name, None)
+                else:
+                    store.files[name] = filename
+        drop_pools = bool(changed & {'Name', 'Sex', 'Race'})
+        index.cache = self.cache.copy(lambda key: key in changed_files or drop_pools and key[0] == self.NAME_POOLS)
+        for store in index.subgroups.values():
+            store.cache = index.cache
+        if index.groups.keys() != self.groups.keys():
+            # list groups in folder order, as a full walk of the database does
+            order = [unicodedata.normalize('NFC', f[:-4]) for f in os.listdir(self.database_dir) if f.endswith('.txt')]
+            index.texts = {name: index.texts[name] for name in order if name in index.texts}
+            index.groups = {name: index.groups[name] for name in order if name in index.groups}
+        return index, changed
+
+    def has_subgroup(self, folder: str, name: str) -> bool:
+        """Check whether a subgroup file exists inside one of the group subfolders."""
+        return folder in self.subgroups and name in self.subgroups[folder]
+
+    def lookup(self, group_name: str) -> Optional[GroupEntries]:
+        """Resolve a group or subgroup name the same way files are searched on disk."""
+        try:
+            location = self._resolved[group_name]
+        except KeyError:
+            location = self._resolved[group_name] = self._locate(group_name)
+        if location is None:
+            return None
+        folder, name = location
+        return self.subgroups[folder].get(name) if folder else self.groups[name]
+
+    def _locate(self, group_name: str) -> Optional[Tuple[str, str]]:
+        """(subfolder, name) of a subgroup file or ('', name) of a group file, remembered instead of entries."""
+        for key in self.SUBFOLDERS:
+            if group_name.endswith(key):
+                if self.has_subgroup(key, group_name):
+                    return key, group_name
+                break
+        if group_name in self.groups:
+            return '', group_name
+        for group in self.groups:
+            if self.has_subgroup(group, group_name):
+                return group, group_name
+        return None
+
+
+class ConfigError(ValueError):
+    """Raised when a rule in config.txt is malformed."""
+
+
+class OptionalRule:
+    """Optional group, kept in an NPC with the given chance in percent."""
+
+    __slots__ = ('group', 'chance')
+
+    def __init__(self, group: str, chance: int):
+        self.group = group
+        self.chance = chance
+
+
+class MultipleRule:
+    """Multiple group, with min_count parameters plus one more for every won roll of chance, up to max_count."""
+
+    __slots__ = ('group', 'chance', 'min_count', 'max_count')
+
+    def __init__(self, group: str, chance: int, min_count: int, max_count: int):
+        self.group = group
+        self.chance = chance
+        self.min_count = min_count
+        self.max_count = max_count
+
+
+class ConditionedRule:
+    """Conditioned group whose parameters depend on the parameters of its influential groups."""
+
+    __slots__ = ('rule', 'group', 'conditions')
+
+    def __init__(self, rule: str, group: str, conditions: Tuple[str, ...]):
+        self.rule = rule
+        self.group = group
+        self.conditions = conditions
+
+
+class CompiledConfig:
+    """
+    Rules of config.txt parsed once into typed objects.
+    Conditioned rules are put in dependency order, so influential groups are always processed first.
+    Malformed rules and circular conditions raise ConfigError instead of being skipped.
+    """
+
+    __slots__ = ('rarity_classes', 'optional', 'multiple', 'conditioned')
+
+    def __init__(self, rarity_classes: List[str], optional_groups: List[str], multiple_groups: List[str],
+                 conditioned_groups: List[str]):
+        self.rarity_classes: Dict[str, int] = {}
+        for rule in self._rules(rarity_classes):
+            parts = self._split(rule)
+            if len(parts) != 2 or not re.fullmatch(r'\w{1,3}', parts[0]):
+                raise ConfigError(f"Rarity rule '{rule}' must look like 'S_by_100'.")
+            if parts[0] in self.rarity_classes:
+                raise ConfigError(f"Rarity class '{parts[0]}' is defined more than once.")
+            self.rarity_classes[parts[0]] = self._percent(parts[1], rule)
+
+        self.optional: List[OptionalRule] = []
+        for rule in self._rules(optional_groups):
+            parts = self._split(rule)
+            if len(parts) != 2:
+                raise ConfigError(f"Optional group rule '{rule}' must look like 'Fear_by_80'.")
+            self.optional.append(OptionalRule(parts[0], self._percent(parts[1], rule)))
+
+        self.multiple: List[MultipleRule] = []
+        for rule in self._rules(multiple_groups):
+            parts = self._split(rule)
+            counts = re.fullmatch(r'min(\d+)max(\d+)', parts[2], re.IGNORECASE) if len(parts) == 3 else None
+            if not counts:
+                raise ConfigError(f"Multiple group rule '{rule}' must look like 'Race_by_20_min1max2'.")
+            min_count, max_count = int(counts.group(1)), int(counts.group(2))
+            if min_count > max_count:
+                raise ConfigError(f"Multiple group rule '{rule}' has min greater than max.")
+            self.multiple.append(MultipleRule(parts[0], self._percent(parts[1], rule), min_count, max_count))
+
+        conditioned = []
+        for rule in self._rules(conditioned_groups):
+            parts = self._split(rule)
+            if len(parts) < 2 or not all(parts):
+                raise ConfigError(f"Conditioned group rule '{rule}' must look like 'Name_by_Sex_Race'.")
+            conditioned.append(ConditionedRule(rule, parts[0], tuple(parts[1:])))
+        self.conditioned = self._dependency_order(conditioned)
+
+    @staticmethod
+    def _rules(lines: List[str]) -> List[str]:
+        return [] if not lines or lines[0] == 'None' else lines
+
+    @staticmethod
+    def _split(rule: str) -> List[str]:
+        return rule.replace('_by_', '_').replace('__', '_').split('_')
+
+    @staticmethod
+    def _percent(value: str, rule: str) -> int:
+        if not value.isdigit() or int(value) > 100:
+            raise ConfigError(f"Rule '{rule}' needs a chance from 0 to 100, got '{value}'.")
+        return int(value)
+
+    @staticmethod
+    def _dependency_order(rules: List[ConditionedRule]) -> List[ConditionedRule]:
+        """Order conditioned rules so influential groups come first, keeping config order where it is valid."""
+        conditioned = {rule.group for rule in rules}
+        ordered: List[ConditionedRule] = []
+        placed = set()
+        remaining = list(rules)
+        while remaining:
+            for rule in remaining:
+                if all(cond in placed or cond not in conditioned for cond in rule.conditions):
+                    ordered.append(rule)
+                    placed.add(rule.group)
+                    remaining.remove(rule)
+                    break
+            else:
+                raise ConfigError("Conditioned groups are circular: " + ', '.join(r.rule for r in remaining))
+        return ordered
+
+
+_FEASIBLE_LOCK = threading.Lock()  # builds one FeasibleSpace at a time, see DatabaseSnapshot.feasible
+
+
+class DatabaseSnapshot:
+    """
+    Loaded config and database with every rule table parsed.
+    A snapshot is never modified by generation, so one snapshot can be shared by any number of concurrent calls.
+    """
+
+    def __init__(self, config: str, index: DatabaseIndex):
+        self.config = config
+        self.index = index
+        self.database_dir = index.database_dir
+        self.database = dict(index.texts)
         self.all_groups = self._extract_groups()
         self.special_groups = self._extract_groups(self.config, '__')
         self.rarity_classes = self.extract_list(self.config, self.special_groups[0], '__')
@@ -38,37 +579,55 @@ class NPCGenerator:
         self.multiple_groups = self.extract_list(self.config, self.special_groups[2], '__')
         self.conditioned_groups = self.extract_list(self.config, self.special_groups[3], '__')
         self.rarity_map: List[Tuple[str, int]] = []
-        self.active_groups: List[str] = []
-        self.groups_and_parameters: List[List[str]] = []
-        self.locked_groups: set = set()
-
-    def _load_config(self, config_file: str) -> None:
-        """Load configuration file."""
-        try:
-            with open(config_file, encoding='utf-8') as f:
-                self.config = f.read()
-        except FileNotFoundError:
-            raise FileNotFoundError(f"Config file {config_file} not found.")
-
-    def _load_database(self) -> None:
-        """Load database files from directory."""
-        self.database = {}
-        try:
-            for filename in os.listdir(self.database_dir):
-                if filename.endswith('.txt'):
-                    group_name = filename[:-4]
-                    file_path = os.path.join(self.database_dir, filename)
-                    with open(file_path, encoding='utf-8') as f:
-                        self.database[group_name] = f.read()
-        except FileNotFoundError:
-            raise FileNotFoundError(f"Database directory {self.database_dir} not found.")
+        self._version: Optional[str] = None
+        self._feasible: Optional[FeasibleSpace] = None
+        self._compile_tables()
+
+    @property
+    def version(self) -> str:
+        """
+        Content hash of the config and every parsed group and subgroup (16 hex digits), computed on first use.
+        Subgroup files are read for it without going through the cache.
+        A seed, this version and the selected parameters identify one NPC, see NPCGenerator.replay().
+        """
+        if self._version is None:
+            digest = hashlib.sha256(self.config.encode('utf-8'))
+            entries = [(name, self.index.groups[name]) for name in self.all_groups]
+            for folder in sorted(self.index.subgroups):
+                store = self.index.subgroups[folder]
+                entries += [(f"{folder}/{name}", store.read(name)) for name in sorted(store)]
+            for name, group in entries:
+                digest.update(f"\0{name}\0".encode('utf-8') + '\n'.join(group.items).encode('utf-8'))
+            self._version = digest.hexdigest()[:16]
+        return self._version
+
+    @property
+    def feasible(self) -> FeasibleSpace:
+        """
+        Feasible Nationality, Race and Sex combinations of this snapshot, worked out on first use.
+        A thread reading it while another builds it waits for that build instead of starting its own.
+        """
+        if self._feasible is None:
+            with _FEASIBLE_LOCK:
+                if self._feasible is None:
+                    self._feasible = FeasibleSpace(self)
+        return self._feasible
+
+    @property
+    def feasible_built(self) -> bool:
+        """Whether feasible has been worked out, so that reading it costs nothing."""
+        return self._feasible is not None
 
     def _extract_groups(self, data: Optional[str] = None, delimiter: Optional[str] = None) -> List[str]:
         """Extract group names from database folder or config string."""
         if data and delimiter:
             pattern = rf'({delimiter}\w+{delimiter})'
             return [g.strip(delimiter) for g in re.findall(pattern, data)]
-        return [filename[:-4] for filename in os.listdir(self.database_dir) if filename.endswith('.txt')]
+        return list(self.index.groups)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit, miss and eviction statistics of the subgroup files and name pools cache, see SubgroupCache."""
+        return self.index.cache.stats()
 
     def extract_list(self, data: Optional[str], group_name: str, delimiter: Optional[str] = None) -> List[str]:
         """Extract elements of a specific group from data string or file."""
@@ -83,446 +642,2283 @@ class NPCGenerator:
             return items if group_name in ['Personalities', 'Religion'] else \
                 [item.replace(' ', '_') for item in items]
 
-        subfolder_map = {
-            'Name': 'Name',
-            'Race': 'Race',
-            'Sex': 'Sex'
-        }
+        entries = self.index.lookup(group_name)
+        return list(entries.items) if entries is not None else ['None']
 
-        subfolder = None
-        for key in subfolder_map:
-            if group_name.endswith(key):
-                subfolder = subfolder_map[key]
-                break
+    def _compile_tables(self) -> None:
+        """Compile config rules and group lists shared by every generated NPC."""
+        self.rules = CompiledConfig(self.rarity_classes, self.optional_groups, self.multiple_groups,
+                                    self.conditioned_groups)
+        self.rarity_map = [[name, prob] for name, prob in self.rules.rarity_classes.items()]
+        self.sampler = RaritySampler(self.rules.rarity_classes)
+        self.nationality_pool = [unicodedata.normalize('NFC', p) for p in self.extract_list(None, 'Nationality')]
+        self.race_by_nationality = 'Race_by_Nationality' in self.conditioned_groups
+        self._compile_validity()
 
-        if subfolder:
-            file_path = os.path.join(self.database_dir, subfolder, f"{group_name}.txt")
-            if os.path.exists(file_path):
-                with open(file_path, encoding='utf-8') as f:
-                    items = f.read().strip().split('\n')
-                    items = [unicodedata.normalize('NFC', item.strip()) for item in items if item.strip()]
-                    return items if group_name in ['Personalities', 'Religion'] else items
-
-        file_path = os.path.join(self.database_dir, f"{group_name}.txt")
-        if os.path.exists(file_path):
-            with open(file_path, encoding='utf-8') as f:
-                items = f.read().strip().split('\n')
-                items = [unicodedata.normalize('NFC', item.strip()) for item in items if item.strip()]
-                return items if group_name in ['Personalities', 'Religion'] else items
-
-        for group in self.all_groups:
-            sub_path = os.path.join(self.database_dir, group, f"{group_name}.txt")
-            if os.path.exists(sub_path):
-                with open(sub_path, encoding='utf-8') as f:
-                    items = f.read().strip().split('\n')
-                    items = [unicodedata.normalize('NFC', item.strip()) for item in items if item.strip()]
-                    return items if group_name in ['Personalities', 'Religion'] else items
-
-        return ['None']
+    @staticmethod
+    def strip_rarity(param: str) -> str:
+        """Parameter name without its rarity suffix."""
+        return RARITY_PATTERN.sub('', param).strip()
+
+    def _valid_names(self, group: str) -> FrozenSet[str]:
+        params = [unicodedata.normalize('NFC', p) for p in self.extract_list(None, group)]
+        if group in ['Nationality', 'Religion']:
+            params = [p.replace('_', ' ') for p in params]
+        return frozenset(self.strip_rarity(p) for p in params)
+
+    def _race_subgroup(self, name: str, suffix: str) -> Optional[GroupEntries]:
+        """Find a Race keyed subgroup file under any of its space and underscore filename variants."""
+        candidates = (f"{name.replace(' ', '_')}{suffix}", f"{name}{suffix}", f"{name.replace('_', ' ')}{suffix}")
+        for candidate in dict.fromkeys(candidates):
+            entries = self.index.lookup(candidate)
+            if entries is not None:
+                return entries
+        return None
+
+    def _compile_validity(self) -> None:
+        """
+        Precompute what later validation needs, so it is a set lookup without parsing or file access:
+        the valid names of every group, the Race entries and names allowed for every Nationality and the
+        Sex names valid for every Race. Nationalities and Races without their own subgroup file get the
+        global Race and Sex lists.
+        """
+        self.valid_params: Dict[str, FrozenSet[str]] = {group: self._valid_names(group) for group in
+                                                        dict.fromkeys(self.all_groups + ['Nationality'])}
+        self.any_choices: Dict[str, Optional[List[Tuple[str, bool, bool]]]] = {}
+        self._compile_nationality_races()
+        self._compile_race_sexes()
+
+    def _compile_nationality_races(self) -> None:
+        race_entries = self.index.lookup('Race') or GroupEntries(('None',))
+        self.nationality_races: Dict[str, GroupEntries] = {}
+        self.nationality_race_names: Dict[str, FrozenSet[str]] = {}
+        for nationality in self.nationality_pool:
+            key = self.nationality_key(nationality)
+            entries = self._race_subgroup(f"Resident_of_{key}", 'Race') or race_entries
+            self.nationality_races[key] = entries
+            self.nationality_race_names[key] = frozenset(self.strip_rarity(p) for p in entries.items)
+
+    def _compile_race_sexes(self) -> None:
+        sexes = self.valid_params.get('Sex', frozenset())
+        sex_entries = self.index.lookup('Sex')
+        self.race_sexes: Dict[str, FrozenSet[str]] = {}
+        self.race_sex_entries: Dict[str, Optional[GroupEntries]] = {}
+        for race in self.valid_params.get('Race', ()):
+            entries = self._race_subgroup(race, 'Sex')
+            self.race_sexes[race] = frozenset(self.strip_rarity(p) for p in entries.items) if entries else sexes
+            self.race_sex_entries[race] = entries or sex_entries
+
+    def updated(self, config: str, index: DatabaseIndex, changed: Set[str]) -> 'DatabaseSnapshot':
+        """
+        New snapshot for an updated config and index that keeps every table the changed groups do not affect.
+        changed holds the groups and group subfolders DatabaseIndex.updated re-read; a new config rebuilds all.
+        """
+        if config != self.config:
+            return DatabaseSnapshot(config, index)
+        snapshot = copy.copy(self)
+        snapshot.index = index
+        snapshot._version = None
+        snapshot._feasible = None
+        snapshot.database = dict(index.texts)
+        snapshot.all_groups = snapshot._extract_groups()
+        if 'Nationality' in changed:
+            snapshot.nationality_pool = [unicodedata.normalize('NFC', p)
+                                         for p in snapshot.extract_list(None, 'Nationality')]
+        snapshot.valid_params = {group: self.valid_params[group] if group in self.valid_params and
+                                 group not in changed else snapshot._valid_names(group)
+                                 for group in dict.fromkeys(snapshot.all_groups + ['Nationality'])}
+        snapshot.any_choices = {group: choices for group, choices in self.any_choices.copy().items()
+                                if group not in changed}
+        if changed & {'Nationality', 'Race'}:
+            snapshot._compile_nationality_races()
+        if changed & {'Race', 'Sex'}:
+            snapshot._compile_race_sexes()
+        snapshot.sampler = self.sampler.copy()
+        return snapshot
 
     @staticmethod
-    def _parse_special_group(group: str) -> List[str]:
-        """Parse a special group string into its components."""
-        return group.replace('_by_', '_').replace('__', '_').split('_')
+    def nationality_key(nationality: str) -> str:
+        """Nationality as the tables key it: without 'Resident of', rarity suffix and underscores."""
+        nationality = unicodedata.normalize('NFC', nationality)
+        for prefix in ('Resident of ', 'Resident_of_'):
+            if nationality.startswith(prefix):
+                nationality = nationality[len(prefix):]
+        return DatabaseSnapshot.strip_rarity(nationality).replace('_', ' ')
+
+    def races_for_nationality(self, nationality: str) -> GroupEntries:
+        """Race entries, with rarity, that a resident of the nationality is drawn from."""
+        key = self.nationality_key(nationality)
+        entries = self.nationality_races.get(key)
+        if entries is None:
+            entries = self._race_subgroup(f"Resident_of_{key}", 'Race') or self.index.lookup('Race') or \
+                GroupEntries(('None',))
+        return entries
+
+    def allowed_races(self, nationality: str) -> FrozenSet[str]:
+        """Race names, without rarity, that are valid for a resident of the nationality."""
+        names = self.nationality_race_names.get(self.nationality_key(nationality))
+        if names is None:
+            names = frozenset(self.strip_rarity(p) for p in self.races_for_nationality(nationality).items)
+        return names
+
+    def sex_entries_for_race(self, race: str) -> Optional[GroupEntries]:
+        """Sex entries, with rarity, that an NPC of the race is drawn from under Sex_by_Race."""
+        race = self.strip_rarity(race)
+        try:
+            return self.race_sex_entries[race]
+        except KeyError:  # a Race spelled differently in a Resident_of_ file than in Race.txt
+            return self._race_subgroup(race, 'Sex') or self.index.lookup('Sex')
+
+    def sexes_for_race(self, race: str) -> FrozenSet[str]:
+        """Sex names, without rarity, that are valid for the race."""
+        return self.race_sexes.get(self.strip_rarity(race), self.valid_params.get('Sex', frozenset()))
+
+    def is_valid(self, group: str, param: str) -> bool:
+        """Check a parameter against the names of its group, ignoring rarity."""
+        names = self.valid_params.get(group)
+        if names is None:
+            names = self._valid_names(group)
+        return self.strip_rarity(unicodedata.normalize('NFC', param)) in names
+
+    def name_sources(self, sexes: List[str], races: List[str]) -> List[GroupEntries]:
+        """
+        Subgroups the Name candidates of a combination of Sex and Race parameters are merged from, in merge order.
+        SexRaceName subgroups are used if any exist, otherwise SexName and RaceName subgroups; empty if none does.
+        """
+        def found(names: Iterable[str]) -> List[GroupEntries]:
+            entries = (self.index.lookup(name.replace(' ', '_')) for name in names)
+            return [e for e in entries if e is not None and e.items != ('None',)]
+
+        return found(f"{sex}_{race}_Name" for sex in sexes for race in races) or \
+            found([f"{sex}Name" for sex in sexes] + [f"{race}Name" for race in races])
+
+    def name_pool(self, sexes: List[str], races: List[str]) -> GroupEntries:
+        """
+        Merged Name candidates for a combination of Sex and Race parameters, built on first use and kept in the
+        index's SubgroupCache next to the subgroup files they are merged from.
+        The subgroups of name_sources() are merged, or Name is used if there are none.
+        Rarity of a name found in more than one subgroup is taken from the later, more specific subgroup.
+        """
+        key = (DatabaseIndex.NAME_POOLS, (tuple(sexes), tuple(races)))
+        pool = self.index.cache.get(key)
+        if pool is not None:
+            return pool
+        sources = self.name_sources(sexes, races)
+        if sources:
+            merged = {'None': 'None'}
+            for entries in sources:
+                merged.update(zip(entries.bases, entries.items))
+            combined_params = tuple(merged.values())
+        else:
+            combined_params = tuple(self.extract_list(None, 'Name'))
+        return self.index.cache.put(key, GroupEntries(combined_params))
+
+    def _resolve_param(self, group: str, param: str) -> Tuple[str, bool, bool]:
+        """Clean a selected parameter and validate it, returning (cleaned value, is valid, locks group)."""
+        param_clean = param if group in ['Nationality', 'Religion'] else param.replace(' ', '_')
+        if group == 'Nationality' and param != 'None':
+            if not param_clean.startswith('Resident of '):
+                param_clean = f"Resident of {param_clean}"
+        is_valid = param == 'Any' or param == 'None' or self.is_valid(group, param)
+        return param_clean, is_valid, param != 'Any' and param != 'None'
+
+    def _any_choices(self, group: str) -> Optional[List[Tuple[str, bool, bool]]]:
+        """Resolved parameters an 'Any' selection for the group is drawn from, built on first use and cached."""
+        try:
+            return self.any_choices[group]
+        except KeyError:
+            pass
+        valid_params = [unicodedata.normalize('NFC', p) for p in self.extract_list(None, group)]
+        choices = None
+        if valid_params and valid_params != ['None']:
+            choices = [self._resolve_param(group, p) for p in valid_params]
+        self.any_choices[group] = choices
+        return choices
+
+    def resolve_selected_params(self, selected_params: Dict[str, str]) -> Optional[List[tuple]]:
+        """
+        Validate selected parameters against this snapshot once, Nationality first.
+        Each step is (group, resolved, choices): a fixed resolved value, or the choices an 'Any' is drawn from.
+        Returns None if a fixed parameter is not valid for its group.
+        """
+        ordered = [(g, p) for g, p in selected_params.items() if g == 'Nationality'] + \
+                  [(g, p) for g, p in selected_params.items() if g != 'Nationality']
+        steps = []
+        for group, param in ordered:
+            param = unicodedata.normalize('NFC', param)
+            choices = None
+            if param == 'Any' and not (group == 'Race' and self.race_by_nationality and
+                                       'Nationality' in selected_params):
+                choices = self._any_choices(group)
+            if choices:
+                steps.append((group, None, choices))
+                continue
+            resolved = self._resolve_param(group, param)
+            if not resolved[1]:
+                return None
+            steps.append((group, resolved, None))
+        return steps
+
+    def invalid_groups(self, selected_params: Dict[str, str]) -> List[str]:
+        """Groups whose selected parameter makes resolve_selected_params refuse the selection."""
+        return [group for group, param in selected_params.items()
+                if not self._resolve_param(group, unicodedata.normalize('NFC', param))[1]]
+
+
+class FeasibleSpace:
+    """
+    Every (Nationality, Race, Sex) combination a snapshot can generate along its Race_by_Nationality, Sex_by_Race
+    and Name_by_Sex_Race rules, weighted by the chance of drawing it: a uniform Nationality, then a Race of the
+    Nationality and a Sex of the Race that pass their rarity roll (see pick_probabilities). Combinations with a
+    zero rarity, or whose name pool only holds names of zero rarity, are left out. A group missing from the
+    database is None in every combination.
+    Name pools are only read when a combination is drawn or counted, so building the space reads no Name files:
+    combinations holds every candidate and named() tells whether it has a name. A draw rejects candidates without
+    one and draws again, which gives exactly the weights of the named combinations.
+    The candidates matching a set of fixed values are collected on first use with their cumulative weights,
+    so drawing one under constraints is a weighted choice. The collected matches and name checks are not pickled.
+    """
+
+    GROUPS = ('Nationality', 'Race', 'Sex')
+    REJECTIONS = 64  # unnamed candidates drawn in a row before a draw filters the candidates by name instead
+
+    def __init__(self, snapshot: DatabaseSnapshot):
+        self.snapshot = snapshot
+        self.combinations: List[Tuple[Optional[str], Optional[str], Optional[str]]] = []
+        self.keys: List[Tuple[Optional[str], Optional[str], Optional[str]]] = []
+        self.weights: List[float] = []
+        self.check_names = False
+        self._matches: Dict[tuple, Tuple[list, list]] = {}
+        self._named: Dict[Tuple[Optional[str], Optional[str]], bool] = {}
+        self._build()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_matches'] = {}
+        state['_named'] = {}
+        return state
 
     @staticmethod
-    def _merge_rarity_lists(base_list: List[str], added_list: List[str]) -> List[str]:
-        """Merge two lists, prioritizing rarity from added_list."""
-        combined = base_list + added_list
-        rarity_pattern = re.compile(r'\(\w{1,3}\)$')
-        result = {}
-        for item in combined:
-            base_item = re.sub(rarity_pattern, '', item)
-            rarity = re.findall(rarity_pattern, item)
-            result[base_item] = item if rarity else base_item
-        return list(result.values())
-
-    def _apply_rarity(self, items: Union[List[str], str], force_select: bool = False) -> List[str]:
-        """Apply rarity classes to filter items based on probability."""
+    def pick_probabilities(probabilities: Tuple[float, ...]) -> List[float]:
+        """
+        Chance that RaritySampler.draw picks each parameter of a list for one slot: the parameter passes its
+        rarity roll and is then picked uniformly among the other survivors, E[1 / (1 + survivors)] times.
+        Parameters sharing a rarity share the chance, so it is worked out once per rarity class.
+        """
+        chances = {}
+        for p in set(probabilities):
+            if p <= 0:
+                chances[p] = 0.0
+                continue
+            others = list(probabilities)
+            others.remove(p)
+            certain = sum(q >= 1 for q in others)
+            # survivors[k]: chance that exactly low + k of the other uncertain parameters pass; the tails below
+            # 1e-17 are cut as they grow, which keeps long lists at O(n * sqrt(n)) instead of O(n^2)
+            survivors = [1.0]
+            low = 0
+            for q in others:
+                if 0 < q < 1:
+                    survivors = [a * (1 - q) + b * q for a, b in zip(survivors + [0.0], [0.0] + survivors)]
+                    while len(survivors) > 1 and survivors[-1] < 1e-17:
+                        survivors.pop()
+                    while len(survivors) > 1 and survivors[0] < 1e-17:
+                        del survivors[0]
+                        low += 1
+            chances[p] = p * sum(c / (certain + low + k + 1) for k, c in enumerate(survivors))
+        return [chances[p] for p in probabilities]
+
+    def _choices(self, entries: Optional[GroupEntries]) -> List[Tuple[str, float]]:
+        """Parameters of a list without rarity, with their pick chance, leaving out those never picked."""
+        if entries is None or entries.items == ('None',):
+            return []
+        table = self.snapshot.sampler.table(entries)
+        return [(base.strip(), chance) for base, chance in
+                zip(table.bases, self.pick_probabilities(table.probabilities)) if chance > 0]
+
+    def _build(self) -> None:
+        snapshot = self.snapshot
+        groups = set(snapshot.all_groups)
+        conditioned = set(snapshot.conditioned_groups)
+        nationalities = [n for n in snapshot.nationality_pool if n != 'None'] if 'Nationality' in groups else []
+        chosen: Dict[Optional[GroupEntries], List[Tuple[str, float]]] = {}
+
+        def choices(entries: Optional[GroupEntries]) -> List[Tuple[str, float]]:
+            if entries not in chosen:
+                chosen[entries] = self._choices(entries)
+            return chosen[entries]
+
+        races_by_key: Dict[Optional[str], List[Tuple[str, float]]] = {}
+        if 'Race' in groups:
+            global_races = choices(snapshot.index.lookup('Race'))
+            for nationality in nationalities:
+                key = snapshot.nationality_key(nationality)
+                races_by_key[key] = choices(snapshot.races_for_nationality(nationality)) \
+                    if snapshot.race_by_nationality else global_races
+            races_by_key[None] = global_races
+        sexes_by_race: Dict[Optional[str], List[Tuple[str, float]]] = {}
+        if 'Sex' in groups:
+            sexes_by_race[None] = choices(snapshot.index.lookup('Sex'))
+            if 'Sex_by_Race' in conditioned:
+                for race, _ in set(itertools.chain.from_iterable(races_by_key.values())):
+                    sexes_by_race[race] = choices(snapshot.sex_entries_for_race(race))
+        self.check_names = 'Name' in groups and 'Name_by_Sex_Race' in conditioned
+
+        for nationality in nationalities or [None]:
+            key = snapshot.nationality_key(nationality) if nationality is not None else None
+            nationality_weight = 1 / len(nationalities) if nationalities else 1.0
+            for race, race_weight in races_by_key.get(key, races_by_key.get(None)) or [(None, 1.0)]:
+                sexes = sexes_by_race.get(race, sexes_by_race.get(None)) if sexes_by_race else None
+                for sex, sex_weight in sexes or [(None, 1.0)]:
+                    self.combinations.append((nationality, race, sex))
+                    self.keys.append((key, race and race.replace('_', ' '), sex and sex.replace('_', ' ')))
+                    self.weights.append(nationality_weight * race_weight * sex_weight)
+
+    def named(self, combination: Tuple[Optional[str], Optional[str], Optional[str]]) -> bool:
+        """Check whether a combination has a name to draw, reading its name pool on first use."""
+        if not self.check_names:
+            return True
+        pair = combination[2], combination[1]
+        found = self._named.get(pair)
+        if found is None:
+            found = self._named[pair] = self._has_names(*pair)
+        return found
+
+    def _has_names(self, sex: Optional[str], race: Optional[str]) -> bool:
+        """Check whether the name pool of a Sex and Race holds a name that can be drawn."""
+        snapshot = self.snapshot
+        sexes = [sex.replace(' ', '_')] if sex is not None else snapshot.extract_list(None, 'Sex')
+        races = [race.replace(' ', '_')] if race is not None else snapshot.extract_list(None, 'Race')
+        sources = snapshot.name_sources(sexes, races) or [e for e in [snapshot.index.lookup('Name')] if e]
+        rarities = {}  # the rarity each name ends up with in name_pool(), without merging the pool itself
+        for entries in sources:
+            rarities.update(zip(entries.bases, entries.rarities))
+        rarities.pop('None', None)
+        return any(snapshot.sampler.probability(rarity) > 0 for rarity in set(rarities.values()))
+
+    def key(self, group: str, param: str) -> str:
+        """A Nationality, Race or Sex parameter as combinations are matched on: no rarity, spaces for underscores."""
+        if group == 'Nationality':
+            return self.snapshot.nationality_key(param)
+        return self.snapshot.strip_rarity(unicodedata.normalize('NFC', param)).replace('_', ' ')
+
+    def constraint(self, selected_params: Dict[str, str]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        """Nationality, Race and Sex keys fixed by selected parameters, None where 'Any' or not selected."""
+        return tuple(None if selected_params.get(group) in (None, 'Any', 'None') else
+                     self.key(group, selected_params[group]) for group in self.GROUPS)
+
+    def candidates(self, selected_params: Dict[str, str], named: bool = False) -> Tuple[list, list]:
+        """
+        Combinations that agree with the selected parameters and their cumulative weights.
+        Unless named is set they include combinations without a name to draw, see named().
+        """
+        constraint = self.constraint(selected_params)
+        named = named and self.check_names
+        found = self._matches.get((constraint, named))
+        if found is None:
+            picks = [i for i, key in enumerate(self.keys)
+                     if all(fixed is None or value is None or fixed == value for fixed, value in zip(constraint, key))]
+            if named:
+                picks = [i for i in picks if self.named(self.combinations[i])]
+            found = self._matches[constraint, named] = (
+                [self.combinations[i] for i in picks], list(itertools.accumulate(self.weights[i] for i in picks)))
+        return found
+
+    def matches(self, selected_params: Dict[str, str]) -> Tuple[list, list]:
+        """Combinations that agree with the selected parameters and have a name, with their cumulative weights."""
+        return self.candidates(selected_params, named=True)
+
+    def exists(self, selected_params: Dict[str, str]) -> bool:
+        """Check whether any combination agrees with the selected parameters, reading as few name pools as it can."""
+        if self.resolve(selected_params) is None:
+            return False
+        return any(self.named(combination) for combination in self.candidates(selected_params)[0])
+
+    def resolve(self, selected_params: Dict[str, str]) -> Optional[List[tuple]]:
+        """
+        Generation steps of the selected parameters outside GROUPS (see resolve_selected_params), None if one is
+        not valid. Nationality, Race and Sex are matched against the combinations instead, since a Race of a
+        Resident_of_ file may be spelled differently from Race.txt.
+        """
+        return self.snapshot.resolve_selected_params({group: param for group, param in selected_params.items()
+                                                      if group not in self.GROUPS})
+
+    def count(self, selected_params: Dict[str, str]) -> int:
+        """Number of feasible combinations under the selected parameters, 0 if one of them is not valid."""
+        if self.resolve(selected_params) is None:
+            return 0
+        return len(self.matches(selected_params)[0])
+
+    def sample(self, selected_params: Dict[str, str], rng: random.Random,
+               steps: Optional[List[tuple]] = None) -> Optional[Tuple[List[tuple], Dict[str, str]]]:
+        """
+        Generation steps and selected parameters with Nationality, Race and Sex fixed to one feasible combination
+        drawn by weight (see fix()), or None if no combination satisfies them.
+        steps are those of resolve(), worked out here if not given.
+        """
+        if steps is None:
+            steps = self.resolve(selected_params)
+            if steps is None:
+                return None
+        combinations, cumulative = self.candidates(selected_params)
+        if not combinations:
+            return None
+        for _ in range(self.REJECTIONS):
+            combination = rng.choices(combinations, cum_weights=cumulative)[0]
+            if self.named(combination):
+                return self.fix(combination, steps, selected_params)
+        combinations, cumulative = self.matches(selected_params)
+        if not combinations:
+            return None
+        return self.fix(rng.choices(combinations, cum_weights=cumulative)[0], steps, selected_params)
+
+    def fix(self, combination: Tuple[Optional[str], Optional[str], Optional[str]], steps: List[tuple],
+            selected_params: Dict[str, str]) -> Tuple[List[tuple], Dict[str, str]]:
+        """
+        Generation steps and selected parameters that set a combination ahead of the resolved steps of the other
+        groups. The combination is taken as built, without validating it again against the group lists.
+        """
+        fixed = dict(selected_params)
+        pinned = []
+        for group, param in zip(self.GROUPS, combination):
+            if param is not None:
+                fixed[group] = param
+                pinned.append((group, (param, True, True), None))
+        return pinned + steps, fixed
+
+
+class NPCRecord:
+    """
+    Parameters of the NPC being built, by group.
+    Groups keep the order they were added in, which is the order print_npc writes them in,
+    while any group can be read, replaced or removed in constant time.
+    """
+
+    __slots__ = ('params',)
+
+    def __init__(self, groups: Iterable[str]):
+        self.params: Dict[str, List[str]] = {group: [''] for group in groups}
+
+    def __contains__(self, group: str) -> bool:
+        return group in self.params
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.params)
+
+    def get(self, group: str) -> Optional[List[str]]:
+        """Parameters of a group, or None if the group is not part of the NPC."""
+        return self.params.get(group)
+
+    def set(self, group: str, params: List[str]) -> None:
+        """Replace the parameters of a group, adding the group at the end if it is new."""
+        self.params[group] = params
+
+    def remove(self, group: str) -> None:
+        """Drop a group from the NPC."""
+        self.params.pop(group, None)
+
+    def is_set(self, group: str) -> bool:
+        """Check whether a group is part of the NPC and already has a parameter."""
+        params = self.params.get(group)
+        return bool(params) and params[0] != ''
+
+    def rows(self) -> List[List[str]]:
+        """The NPC as [group, parameter, ...] rows in output order."""
+        return [[group] + params for group, params in self.params.items()]
+
+
+class GenerationContext:
+    """
+    State of one generation call: the snapshot it reads, its random streams and the NPC being built.
+    Every call gets its own context, so concurrent callers never share per-NPC state.
+    """
+
+    __slots__ = ('snapshot', 'rng', 'record', 'locked_groups')
+    instrumented = False  # InstrumentedContext counts and times what the hot path reports through count()
+
+    def __init__(self, snapshot: DatabaseSnapshot, rng: random.Random):
+        self.snapshot = snapshot
+        self.rng = rng
+        self.record = NPCRecord(())
+        self.locked_groups: set = set()
+
+    def count(self, counter: str, n: int = 1) -> None:
+        """Instrumentation hook, a no-op unless the context is an InstrumentedContext."""
+
+    def _draw_parameters(self, items: Union[List[str], str, GroupEntries], k: int,
+                         force_select: bool = False) -> List[str]:
+        """Draw up to k distinct parameters that pass their rarity roll; with force_select never come back empty."""
+        sampler = self.snapshot.sampler
         if isinstance(items, str):
-            items = self.extract_list(None, items)
-        if not items or items == ['None']:
-            return ['None'] if force_select else []
-        filtered_items = []
-        rarity_pattern = re.compile(r'\(\w{1,3}\)$')
-        for item in items:
-            rarity_match = re.findall(rarity_pattern, item)
-            rarity_class = rarity_match[0][1:-1] if rarity_match else ''
-            try:
-                rarity_prob = next(r[1] for r in self.rarity_map if r[0] == rarity_class)
-            except StopIteration:
-                rarity_prob = int(rarity_class) if rarity_class.isdigit() else 100
-            if rarity_prob >= random.randint(1, 100):
-                filtered_items.append(re.sub(rarity_pattern, '', item))
-        if not filtered_items and force_select and items and items != ['None']:
-            selected = re.sub(rarity_pattern, '', random.choice(items))
-            return [selected]
-        return filtered_items if filtered_items or not force_select else []
-
-    def _process_rarity_classes(self) -> None:
-        """Parse rarity classes from config into rarity map."""
-        self.rarity_map = []
-        for rarity in self.rarity_classes:
-            try:
-                parts = self._parse_special_group(rarity)
-                self.rarity_map.append([parts[0], int(parts[1])])
-            except (IndexError, ValueError):
-                pass
+            key = self.snapshot.index.lookup(items.replace(' ', '_'))
+            items = key.items if key is not None else ()
+        elif isinstance(items, GroupEntries):
+            key, items = items, items.items
+        else:
+            key = items = tuple(items)
+        if not items or items == ('None',):
+            return ['None'] * k if force_select else []
+        table = sampler.table(key)
+        picks = sampler.draw(table, k, self)
+        if not picks and force_select:
+            self.count('forced_choices')
+            return [sampler.choice(table, self)] * k
+        return picks
 
     def _process_optional_groups(self, locked_groups: set) -> None:
         """Remove optional groups based on probability, respecting locked groups."""
-        for group in self.optional_groups:
-            parts = self._parse_special_group(group)
-            group_name = parts[0]
+        for rule in self.snapshot.rules.optional:
+            group_name = rule.group
             if group_name in locked_groups:
                 continue
-            if int(parts[1]) <= random.randint(1, 100):
-                if group_name in self.active_groups:
-                    self.active_groups.remove(group_name)
-                self.groups_and_parameters = [g for g in self.groups_and_parameters if g[0] != group_name]
+            if rule.chance <= self.rng.randint(1, 100):
+                self.record.remove(group_name)
 
     def _process_multiple_groups(self, locked_groups: set) -> None:
         """Handle groups that can have multiple parameters, preserving locked or conditioned parameters."""
-        for group in self.multiple_groups:
-            parts = self._parse_special_group(group)
-            group_name, chance, minmax = parts[0], int(parts[1]), parts[2]
-            min_count, max_count = map(int, re.findall(r'\d+', minmax))
-
-            count = min_count
-            for _ in range(max_count - min_count):
-                if int(chance) >= random.randint(1, 100):
+        for rule in self.snapshot.rules.multiple:
+            group_name = rule.group
+            count = rule.min_count
+            for _ in range(rule.max_count - rule.min_count):
+                if rule.chance >= self.rng.randint(1, 100):
                     count += 1
 
-            idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == group_name), None)
-            if idx is not None:
-                current_params = self.groups_and_parameters[idx][1:]
+            current_params = self.record.get(group_name)
+            if current_params is not None:
                 if group_name in locked_groups or group_name in self.locked_groups:
                     if current_params and any(p != '' for p in current_params):
                         non_empty_params = [p for p in current_params if p != '']
-                        self.groups_and_parameters[idx] = [group_name] + non_empty_params + [''] * (count - len(non_empty_params))
+                        self.record.set(group_name, non_empty_params + [''] * (count - len(non_empty_params)))
                     else:
-                        self.groups_and_parameters[idx] = [group_name] + [''] * count
-                elif group_name == 'Race' and 'Race_by_Nationality' in self.conditioned_groups and \
-                     any(p[0] == 'Nationality' and len(p) > 1 and p[1] != '' for p in self.groups_and_parameters):
-                    self.groups_and_parameters[idx] = [group_name] + [''] * count
+                        self.record.set(group_name, [''] * count)
                 else:
-                    self.groups_and_parameters[idx] = [group_name] + [''] * count
+                    self.record.set(group_name, [''] * count)
 
     def _process_conditioned_groups(self, select_params: bool = False,
                                     selected_params: Optional[Dict[str, str]] = None) -> None:
         """Handle conditioned groups by adjusting active groups and selecting parameters."""
-        for group in self.conditioned_groups:
-            parts = self._parse_special_group(group)
-            main_group = parts[0]
-            conditions = parts[1:]
+        for rule in self.snapshot.rules.conditioned:
+            main_group = rule.group
+            conditions = rule.conditions
 
             if select_params:
                 if selected_params and main_group in selected_params and selected_params[main_group] != 'Any':
-                    idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == main_group), None)
-                    if idx is not None and self.groups_and_parameters[idx][1] != '':
+                    if self.record.is_set(main_group):
                         continue
 
                 condition_params = []
                 for cond in conditions:
-                    idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == cond), None)
-                    if idx is not None and self.groups_and_parameters[idx][1] != '':
-                        condition_params.append(
-                            [param.replace(' ', '_') for param in self.groups_and_parameters[idx][1:]])
+                    if self.record.is_set(cond):
+                        condition_params.append([param.replace(' ', '_') for param in self.record.get(cond)])
                     elif selected_params and cond in selected_params and selected_params[cond] != 'Any':
                         condition_params.append([selected_params[cond].replace(' ', '_')])
                     else:
-                        condition_params.append(self.extract_list(None, cond))
+                        condition_params.append(self.snapshot.extract_list(None, cond))
 
                 params = ['None']
                 if main_group == 'Name':
-                    combined_params = ['None']
-                    for sex in condition_params[0]:
-                        for race in condition_params[1]:
-                            subgroup = f"{sex}_{race}_Name"
-                            sub_params = self.extract_list(None, subgroup)
-                            if sub_params != ['None']:
-                                combined_params = self._merge_rarity_lists(combined_params, sub_params)
-                    if combined_params == ['None']:
-                        for sex in condition_params[0]:
-                            sex_subgroup = f"{sex}Name"
-                            sex_names = self.extract_list(None, sex_subgroup)
-                            if sex_names != ['None']:
-                                combined_params = self._merge_rarity_lists(combined_params, sex_names)
-                        for race in condition_params[1]:
-                            race_subgroup = f"{race}Name"
-                            race_names = self.extract_list(None, race_subgroup)
-                            if race_names != ['None']:
-                                combined_params = self._merge_rarity_lists(combined_params, race_names)
-                        if combined_params == ['None']:
-                            combined_params = self.extract_list(None, main_group)
-                    params = combined_params
+                    params = self.snapshot.name_pool(condition_params[0], condition_params[1])
 
                 elif main_group == 'Race':
                     nationality = None
                     if selected_params and 'Nationality' in selected_params and selected_params['Nationality'] != 'Any':
                         nationality = selected_params['Nationality']
                     else:
-                        idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == 'Nationality'), None)
-                        if idx is not None and self.groups_and_parameters[idx][1] != '':
-                            nationality = self.groups_and_parameters[idx][1]
+                        if self.record.is_set('Nationality'):
+                            nationality = self.record.get('Nationality')[0]
 
                     if nationality:
-                        if nationality.startswith('Resident of '):
-                            nationality = nationality[len('Resident of '):]
-                        nationality = nationality.replace(' ', '_')
-                        expected_subgroup = f"Resident_of_{nationality}Race"
-                        race_file = os.path.join(self.database_dir, 'Race', f"{expected_subgroup}.txt")
-                        if os.path.exists(race_file):
-                            params = self.extract_list(None, expected_subgroup)
-                        else:
-                            params = self.extract_list(None, 'Race')
+                        params = self.snapshot.races_for_nationality(nationality)
                         if selected_params.get('Race', 'Any') != 'Any':
-                            selected_race = re.sub(r'\(\w{1,3}\)$', '', selected_params['Race']).strip()
-                            valid_races = [re.sub(r'\(\w{1,3}\)$', '', p).strip() for p in params]
-                            if selected_race in valid_races:
+                            selected_race = self.snapshot.strip_rarity(selected_params['Race'])
+                            if selected_race in self.snapshot.allowed_races(nationality):
                                 params = [selected_race]
                             else:
+                                self.count('race_not_allowed')
                                 params = ['None']
                     else:
-                        params = self.extract_list(None, 'Race')
+                        params = self.snapshot.extract_list(None, 'Race')
 
                     force_select = main_group in ['Race', 'Sex'] and any(condition_params)
                     self._select_parameters([main_group], params, force_select=force_select, overwrite=True)
-                    if main_group == 'Race' and params != ['None'] and self.groups_and_parameters[idx][1] != '':
+                    if main_group == 'Race' and params != ['None'] and self.record.is_set('Nationality'):
                         self.locked_groups.add(main_group)
 
                 elif main_group == 'Sex':
-                    params = self.extract_list(None, main_group)
+                    if self.record.is_set('Race'):
+                        params = self.snapshot.sex_entries_for_race(self.record.get('Race')[0]) or ['None']
+                    else:
+                        params = self.snapshot.extract_list(None, main_group)
 
                 force_select = main_group in ['Race', 'Sex'] and any(condition_params)
                 self._select_parameters([main_group], params, force_select=force_select, overwrite=True)
 
-    def _select_parameters(self, groups: List[str], params: Optional[List[str]] = None,
+    def _select_parameters(self, groups: List[str], params: Union[List[str], GroupEntries, None] = None,
                            force_select: bool = False, overwrite: bool = False) -> None:
         """Select parameters for given groups."""
         for group in groups:
-            active_params = self._apply_rarity(params if params else group, force_select=force_select)
-            idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == group), None)
-            if idx is not None:
-                current_params = self.groups_and_parameters[idx][1:]
-                used_indices = []
+            current_params = self.record.get(group)
+            if current_params is not None:
                 if overwrite or not any(p != '' for p in current_params):
-                    self.groups_and_parameters[idx] = [group] + [''] * len(current_params)
-                    for i in range(1, len(current_params) + 1):
-                        if active_params:
-                            choice_idx = random.randint(0, len(active_params) - 1)
-                            while choice_idx in used_indices and len(used_indices) < len(active_params):
-                                choice_idx = random.randint(0, len(active_params) - 1)
-                            used_indices.append(choice_idx)
-                            self.groups_and_parameters[idx][i] = active_params[choice_idx]
+                    row = [''] * len(current_params)
+                    slots = list(range(len(current_params)))
                 else:
-                    for i, param in enumerate(current_params, start=1):
-                        if param == '' and active_params:
-                            choice_idx = random.randint(0, len(active_params) - 1)
-                            while choice_idx in used_indices and len(used_indices) < len(active_params):
-                                choice_idx = random.randint(0, len(active_params) - 1)
-                            used_indices.append(choice_idx)
-                            self.groups_and_parameters[idx][i] = active_params[choice_idx]
-                self.groups_and_parameters[idx] = [p for p in self.groups_and_parameters[idx] if p]
-
-    def generate(self, selected_params: Optional[Dict[str, str]] = None) -> List[List[str]]:
-        """Generate a new NPC, optionally with specific parameters for any group."""
-        selected_params = selected_params or {}
-        self.locked_groups = set()
-
-        self.rarity_map = []
-        self.active_groups = self.all_groups.copy()
-        self.groups_and_parameters = [[group, ''] for group in self.all_groups]
-        locked_groups = set()
-
-        if 'Nationality' in selected_params:
-            group, param = 'Nationality', selected_params['Nationality']
-            param = unicodedata.normalize('NFC', param)
-            if param == 'Any':
-                valid_params = self.extract_list(None, group)
-                valid_params = [unicodedata.normalize('NFC', p) for p in valid_params]
-                if valid_params and valid_params != ['None']:
-                    param = random.choice(valid_params)
-            param_clean = param if group in ['Nationality', 'Religion'] else param.replace(' ', '_')
-            if group == 'Nationality' and param != 'None':
-                if not param_clean.startswith('Resident of '):
-                    param_clean = f"Resident of {param_clean}"
-            valid_params = self.extract_list(None, group)
-            valid_params = [unicodedata.normalize('NFC', p) for p in valid_params]
-            valid_params_clean = [p.replace('_', ' ') if group in ['Nationality', 'Religion'] else p for p in valid_params]
-            param_for_validation = re.sub(r'\(\w{1,3}\)$', '', param).strip()
-            valid_params_clean = [re.sub(r'\(\w{1,3}\)$', '', p).strip() for p in valid_params_clean]
-            if param != 'Any' and param_for_validation not in valid_params_clean and param != 'None':
-                return []
-            idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == group), None)
-            if idx is None:
-                self.active_groups.append(group)
-                self.groups_and_parameters.append([group, param_clean])
-            else:
-                self.groups_and_parameters[idx] = [group, param_clean]
-            if param != 'Any' and param != 'None':
+                    row = current_params
+                    slots = [i for i, param in enumerate(current_params) if param == '']
+                picks = self._draw_parameters(params if params else group, len(slots), force_select=force_select)
+                for slot, pick in zip(slots, picks):
+                    row[slot] = pick
+                self.record.set(group, [p for p in row if p])
+
+    def _apply_selected(self, steps: List[tuple], locked_groups: set) -> bool:
+        """Set the selected parameters, drawing those chosen as 'Any', and the Nationality; False if one is invalid."""
+        record = self.record
+        for group, resolved, choices in steps:
+            param_clean, is_valid, locks = resolved if choices is None else self.rng.choice(choices)
+            if not is_valid:
+                self.count('invalid_choices')
+                return False
+            record.set(group, [param_clean])
+            if locks:
                 locked_groups.add(group)
 
-        for group, param in [(g, p) for g, p in selected_params.items() if g != 'Nationality']:
-            param = unicodedata.normalize('NFC', param)
-            if param == 'Any' and not (group == 'Race' and 'Race_by_Nationality' in self.conditioned_groups and
-                                       any(p[0] == 'Nationality' and p[1] != '' for p in self.groups_and_parameters)):
-                valid_params = self.extract_list(None, group)
-                valid_params = [unicodedata.normalize('NFC', p) for p in valid_params]
-                if valid_params and valid_params != ['None']:
-                    param = random.choice(valid_params)
-            param_clean = param if group in ['Nationality', 'Religion'] else param.replace(' ', '_')
-            if group == 'Nationality' and param != 'None':
-                if not param_clean.startswith('Resident of '):
-                    param_clean = f"Resident of {param_clean}"
-            valid_params = self.extract_list(None, group)
-            valid_params = [unicodedata.normalize('NFC', p) for p in valid_params]
-            valid_params_clean = [p.replace('_', ' ') if group in ['Nationality', 'Religion'] else p for p in valid_params]
-            param_for_validation = re.sub(r'\(\w{1,3}\)$', '', param).strip()
-            valid_params_clean = [re.sub(r'\(\w{1,3}\)$', '', p).strip() for p in valid_params_clean]
-            if param != 'Any' and param_for_validation not in valid_params_clean and param != 'None':
-                return []
-            idx = next((i for i, g in enumerate(self.groups_and_parameters) if g[0] == group), None)
-            if idx is None:
-                self.active_groups.append(group)
-                self.groups_and_parameters.append([group, param_clean])
+        if 'Nationality' not in locked_groups and not record.is_set('Nationality'):
+            nationality_pool = self.snapshot.nationality_pool
+            if nationality_pool and nationality_pool != ['None']:
+                record.set('Nationality', [self.rng.choice(nationality_pool)])
+        return True
+
+    def _fill_selected(self, locked_groups: set) -> None:
+        """
+        Draw the empty slots a multiple group rule added next to a selected parameter, from the parameters the group
+        would have been drawn from, without repeating the selected one.
+        """
+        record = self.record
+        snapshot = self.snapshot
+        for group in [group for group in record if group in locked_groups]:
+            row = record.get(group)
+            if row[0] == '' or '' not in row:
+                continue
+            if group == 'Race' and snapshot.race_by_nationality and record.is_set('Nationality'):
+                entries = snapshot.races_for_nationality(record.get('Nationality')[0])
             else:
-                self.groups_and_parameters[idx] = [group, param_clean]
-            if param != 'Any' and param != 'None':
-                locked_groups.add(group)
+                entries = snapshot.index.lookup(group.replace(' ', '_'))
+            taken = {snapshot.strip_rarity(param) for param in row if param}
+            pool = [item for item, base in zip(entries.items, entries.bases) if base.strip() not in taken] \
+                if entries is not None else []
+            picks = iter(self._draw_parameters(pool, row.count('')) if pool else ())
+            record.set(group, [param for param in (param or next(picks, '') for param in row) if param])
+
+    def generate(self, steps: List[tuple], selected_params: Dict[str, str],
+                 fill_selected: bool = False) -> List[List[str]]:
+        """
+        Generate one NPC from selected parameters resolved by DatabaseSnapshot.resolve_selected_params.
+        With fill_selected, a group with a selected parameter still gets the extra parameters of its multiple rule.
+        """
+        snapshot = self.snapshot
+        race_by_nationality = snapshot.race_by_nationality
+        self.locked_groups = set()
+        self.record = record = NPCRecord(snapshot.all_groups)
+        locked_groups = set()
 
-        if 'Nationality' not in locked_groups and not any(
-                g[0] == 'Nationality' and len(g) > 1 and g[1] != '' for g in self.groups_and_parameters):
-            valid_nationalities = self.extract_list(None, 'Nationality')
-            valid_nationalities = [unicodedata.normalize('NFC', p) for p in valid_nationalities]
-            if valid_nationalities and valid_nationalities != ['None']:
-                nationality = random.choice(valid_nationalities)
-                if 'Nationality' not in self.active_groups:
-                    self.active_groups.append('Nationality')
-                    self.groups_and_parameters.append(['Nationality', nationality])
-                else:
-                    idx = next(i for i, g in enumerate(self.groups_and_parameters) if g[0] == 'Nationality')
-                    self.groups_and_parameters[idx] = ['Nationality', nationality]
+        if not self._apply_selected(steps, locked_groups):
+            return []
 
-        if 'Race_by_Nationality' in self.conditioned_groups and \
-           any(p[0] == 'Nationality' and len(p) > 1 and p[1] != '' for p in self.groups_and_parameters):
+        if race_by_nationality and record.is_set('Nationality'):
             locked_groups.add('Race')
 
-        self._process_rarity_classes()
-        if self.optional_groups and self.optional_groups[0] != 'None':
+        if snapshot.rules.optional:
             self._process_optional_groups(locked_groups)
-        if self.multiple_groups and self.multiple_groups[0] != 'None':
+        if snapshot.rules.multiple:
             self._process_multiple_groups(locked_groups)
-        if self.conditioned_groups and self.conditioned_groups[0] != 'None':
+            if fill_selected:
+                self._fill_selected(locked_groups)
+        if snapshot.rules.conditioned:
             self._process_conditioned_groups(select_params=True, selected_params=selected_params)
 
-        groups_to_select = [g for g in self.active_groups if not any(
-            g == p[0] and len(p) > 1 and p[1] != '' for p in self.groups_and_parameters) and
-            (g != 'Race' if 'Race_by_Nationality' in self.conditioned_groups and
-             any(p[0] == 'Nationality' and len(p) > 1 and p[1] != '' for p in self.groups_and_parameters) else True)]
+        nationality_set = race_by_nationality and record.is_set('Nationality')
+        groups_to_select = [g for g in record if not record.is_set(g) and not (g == 'Race' and nationality_set)]
         self._select_parameters(groups_to_select)
 
-        return self.groups_and_parameters
+        return record.rows()
+
+
+class GenerationMetrics:
+    """
+    Opt-in counters and stage timers of NPC generation, filled by InstrumentedContext (see NPCGenerator.instrument).
+    Calls from every thread add to the same metrics, and chunks generated in worker processes are merged in.
+    Exported as a JSON-ready dict with to_dict() or in the Prometheus text format with to_prometheus().
+    """
+
+    STAGES = ('nationality', 'optional', 'multiple', 'conditioned', 'select')
+    COUNTERS = {
+        'draws': "Parameter draws, one per group filled",
+        'draw_rejections': "Parameters visited by a draw that failed their rarity roll",
+        'draw_exhausted': "Draws that ran out of parameters before filling every slot",
+        'forced_choices': "Draws where no parameter passed rarity and one was picked ignoring it",
+        'invalid_choices': "NPCs dropped because a parameter drawn for 'Any' was not valid",
+        'race_not_allowed': "Selected races not allowed for the NPC's nationality",
+        'duplicates': "NPCs whose uniqueness key was already produced, see NPCGenerator.generate_unique",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        """Set every counter and timer back to zero."""
+        with self._lock:
+            self.npcs = 0
+            self.empty = 0
+            self.seconds = 0.0
+            self.stage_seconds = dict.fromkeys(self.STAGES, 0.0)
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.rejections: Dict[str, int] = {}
+
+    def add(self, generated: bool, seconds: float, timings: Dict[str, float], counts: Dict[str, int]) -> None:
+        """Add one generation call measured by an InstrumentedContext."""
+        with self._lock:
+            if generated:
+                self.npcs += 1
+            else:
+                self.empty += 1
+            self.seconds += seconds
+            for stage, stage_seconds in timings.items():
+                self.stage_seconds[stage] += stage_seconds
+            for counter, n in counts.items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, values: dict) -> None:
+        """Add the to_dict() values of another GenerationMetrics, e.g. one filled in a worker process."""
+        with self._lock:
+            self.npcs += values['npcs']
+            self.empty += values['empty']
+            self.seconds += values['seconds']
+            for stage, stage_seconds in values['stage_seconds'].items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + stage_seconds
+            for counter, n in values['counters'].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            for group, n in values['rejections'].items():
+                self.rejections[group] = self.rejections.get(group, 0) + n
+
+    def reject(self, groups: Iterable[str]) -> None:
+        """Count selected parameters that were refused before generation, by group."""
+        with self._lock:
+            for group in groups:
+                self.rejections[group] = self.rejections.get(group, 0) + 1
+
+    def to_dict(self, cache: Optional[Dict[str, int]] = None) -> dict:
+        """Current values, with the SubgroupCache statistics if given."""
+        with self._lock:
+            result = {'npcs': self.npcs, 'empty': self.empty, 'seconds': self.seconds,
+                      'stage_seconds': dict(self.stage_seconds), 'counters': dict(self.counters),
+                      'rejections': dict(self.rejections)}
+        if cache is not None:
+            result['cache'] = dict(cache)
+        return result
+
+    def to_prometheus(self, cache: Optional[Dict[str, int]] = None) -> str:
+        """Current values in the Prometheus text exposition format, with the SubgroupCache statistics if given."""
+        values = self.to_dict(cache)
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+        metric('npc_generated_total', 'counter', "NPCs generated", [('', values['npcs'])])
+        metric('npc_empty_total', 'counter', "Generation calls that returned no NPC", [('', values['empty'])])
+        metric('npc_generate_seconds_total', 'counter', "Time spent generating NPCs", [('', values['seconds'])])
+        metric('npc_stage_seconds_total', 'counter', "Time spent in each generation stage",
+               [(f'{{stage="{stage}"}}', seconds) for stage, seconds in values['stage_seconds'].items()])
+        for counter, n in values['counters'].items():
+            metric(f'npc_{counter}_total', 'counter', self.COUNTERS.get(counter, counter), [('', n)])
+        metric('npc_rejected_selections_total', 'counter', "Selected parameters refused as not valid, by group",
+               [(f'{{group="{group}"}}', n) for group, n in sorted(values['rejections'].items())])
+        if cache is not None:
+            for key in ('hits', 'misses', 'evictions'):
+                metric(f'npc_subgroup_cache_{key}_total', 'counter', f"Subgroup cache {key}", [('', cache[key])])
+            for key in ('entries', 'bytes', 'max_bytes'):
+                metric(f'npc_subgroup_cache_{key}', 'gauge', f"Subgroup cache {key.replace('_', ' ')}",
+                       [('', cache[key])])
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedContext(GenerationContext):
+    """
+    GenerationContext that times every generation stage and counts draws, rejections and fallbacks, adding them
+    to its GenerationMetrics after each NPC. Nested stages count towards the outermost one only.
+    """
+
+    __slots__ = ('metrics', 'counts', 'timings', '_stage')
+    instrumented = True
+
+    def __init__(self, metrics: GenerationMetrics, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+        self.counts: Dict[str, int] = {}
+        self.timings = dict.fromkeys(GenerationMetrics.STAGES, 0.0)
+        self._stage = None
+
+    def count(self, counter: str, n: int = 1) -> None:
+        self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def _timed(self, stage: str, method, *args, **kwargs):
+        if self._stage is not None:
+            return method(*args, **kwargs)
+        self._stage = stage
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+            self._stage = None
+
+    def _apply_selected(self, *args, **kwargs):
+        return self._timed('nationality', super()._apply_selected, *args, **kwargs)
+
+    def _process_optional_groups(self, *args, **kwargs):
+        return self._timed('optional', super()._process_optional_groups, *args, **kwargs)
+
+    def _process_multiple_groups(self, *args, **kwargs):
+        return self._timed('multiple', super()._process_multiple_groups, *args, **kwargs)
+
+    def _process_conditioned_groups(self, *args, **kwargs):
+        return self._timed('conditioned', super()._process_conditioned_groups, *args, **kwargs)
+
+    def _select_parameters(self, *args, **kwargs):
+        return self._timed('select', super()._select_parameters, *args, **kwargs)
+
+    def generate(self, steps: List[tuple], selected_params: Dict[str, str],
+                 fill_selected: bool = False) -> List[List[str]]:
+        start = time.perf_counter()
+        npc = super().generate(steps, selected_params, fill_selected)
+        self.metrics.add(bool(npc), time.perf_counter() - start, self.timings, self.counts)
+        self.counts = {}
+        self.timings = dict.fromkeys(GenerationMetrics.STAGES, 0.0)
+        return npc
+
+
+def apportion(total: int, weights: List[float], rng: random.Random) -> List[int]:
+    """
+    Split total into whole counts proportional to weights: every weight gets the floor of its exact share and the
+    units left over go to shares drawn by their fractional parts, without replacement.
+    """
+    weight_sum = sum(weights)
+    if total <= 0 or weight_sum <= 0:
+        return [0] * len(weights)
+    shares = [total * w / weight_sum for w in weights]
+    counts = [int(share) for share in shares]
+    fractions = [share - count for share, count in zip(shares, counts)]
+    for _ in range(total - sum(counts)):
+        if sum(fractions) <= 0:
+            fractions = [w if w > 0 else 0.0 for w in weights]
+        i = rng.choices(range(len(weights)), weights=fractions)[0]
+        counts[i] += 1
+        fractions[i] = 0.0
+    return counts
+
+
+class Population:
+    """
+    NPCs of one generate_population() call stored by column: for every group a list holding one tuple of
+    parameters per NPC, empty where the NPC lacks the group. Equal single parameters share one tuple, so a
+    column costs a list slot per NPC. row() and rows() give NPCs in the [group, parameter, ...] form of generate().
+    """
+
+    __slots__ = ('groups', 'columns')
+
+    def __init__(self, groups: List[str], columns: Dict[str, List[Tuple[str, ...]]]):
+        self.groups = groups
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), ()))
+
+    def row(self, i: int) -> List[List[str]]:
+        """NPC i as [group, parameter, ...] rows in group order."""
+        return [[group, *self.columns[group][i]] for group in self.groups if self.columns[group][i]]
+
+    def rows(self) -> Iterator[List[List[str]]]:
+        """Every NPC as generate() returns them, one at a time."""
+        return (self.row(i) for i in range(len(self)))
+
+    def counts(self, group: str) -> Dict[str, int]:
+        """How many NPCs have each parameter of a group."""
+        return dict(collections.Counter(itertools.chain.from_iterable(self.columns[group])))
+
+    def to_dict(self) -> Dict[str, List[List[str]]]:
+        """The columns as JSON-ready lists."""
+        return {group: [list(params) for params in self.columns[group]] for group in self.groups}
+
+
+class PopulationBuilder:
+    """
+    Builds a Population of size NPCs in one pass instead of size generate() calls.
+    Nationality, Race and Sex counts are apportioned up front from the weights of the snapshot's FeasibleSpace,
+    Nationality first and every later group within the counts of the one before it. Whether each optional group
+    is present and how many parameters each multiple group holds are apportioned from their config chances, and
+    so is the first parameter of every other group from its pick chances. Quotas fix the number of NPCs with a
+    parameter exactly, the rest follow the weights. Further parameters of multiple groups are drawn like
+    generate() draws them, extra races from the races of the NPC's Nationality. Names are then drawn for every
+    Sex and Race block from one name pool, the pool of all its races for an NPC with several.
+    Nationality and Sex hold one parameter per NPC.
+    """
+
+    TREE = FeasibleSpace.GROUPS
+
+    def __init__(self, ctx: GenerationContext, size: int, selected_params: Dict[str, str],
+                 quotas: Dict[str, Dict[str, int]]):
+        self.ctx = ctx
+        self.snapshot = ctx.snapshot
+        self.size = size
+        self.selected_params = selected_params
+        self.feasible = self.snapshot.feasible
+        self.quotas = {group: {self.feasible.key(group, param): n for param, n in quota.items()}
+                       for group, quota in quotas.items()}
+        self._singles: Dict[str, Tuple[str]] = {}
+
+    def single(self, param: str) -> Tuple[str]:
+        """Shared one-parameter tuple of a column."""
+        single = self._singles.get(param)
+        if single is None:
+            single = self._singles[param] = (param,)
+        return single
+
+    def allocate(self, group: str, parents: Dict[tuple, int], options: Dict[tuple, Dict[str, float]],
+                 quota: Dict[str, int]) -> Dict[tuple, int]:
+        """
+        Split the NPC count of every parent tuple over the weighted option keys of the group, returning the
+        counts of every parent tuple extended by an option key. Quota keys get exactly their count, spread over
+        the parents by the parent count times the share of the key's weight.
+        """
+        rng = self.ctx.rng
+        remaining = dict(parents)
+        totals = {parent: sum(choices.values()) for parent, choices in options.items()}
+        counts: Dict[tuple, int] = collections.Counter()
+        for key, wanted in quota.items():
+            while wanted > 0:
+                candidates = [parent for parent, left in remaining.items()
+                              if left > 0 and options[parent].get(key, 0) > 0]
+                if not candidates:
+                    raise ValueError(f"Quota of {quota[key]} for {group} '{key}' cannot be met")
+                shares = apportion(wanted, [remaining[parent] * options[parent][key] / totals[parent]
+                                            for parent in candidates], rng)
+                for parent, share in zip(candidates, shares):
+                    share = min(share, remaining[parent])
+                    counts[parent + (key,)] += share
+                    remaining[parent] -= share
+                    wanted -= share
+        for parent, left in remaining.items():
+            if not left:
+                continue
+            free = [(key, weight) for key, weight in options[parent].items() if key not in quota and weight > 0]
+            if not free:
+                raise ValueError(f"Quotas for {group} leave {left} NPCs without a feasible {group}")
+            for (key, _), share in zip(free, apportion(left, [weight for _, weight in free], rng)):
+                if share:
+                    counts[parent + (key,)] += share
+        return counts
+
+    def multiplicities(self, group: str, locked: bool) -> List[int]:
+        """Number of parameters of the group for every NPC, 0 where an optional group is left out, shuffled."""
+        rng = self.ctx.rng
+        rules = self.snapshot.rules
+        present = self.size
+        optional = next((rule for rule in rules.optional if rule.group == group), None)
+        if optional is not None and not locked:
+            # generate() keeps the group when chance > randint(1, 100)
+            present = apportion(self.size, [optional.chance - 1, 101 - optional.chance], rng)[0]
+        sizes = [1] * present
+        multiple = next((rule for rule in rules.multiple if rule.group == group), None)
+        if multiple is not None:
+            extra = multiple.max_count - multiple.min_count
+            p = min(max(multiple.chance / 100, 0.0), 1.0)
+            odds = [math.comb(extra, j) * p ** j * (1 - p) ** (extra - j) for j in range(extra + 1)]
+            sizes = [multiple.min_count + j for j, share in enumerate(apportion(present, odds, rng))
+                     for _ in range(share)]
+        sizes += [0] * (self.size - present)
+        rng.shuffle(sizes)
+        return sizes
+
+    def fill(self, group: str, table: RarityTable, first: str, k: int) -> Tuple[str, ...]:
+        """first followed by k - 1 other parameters drawn from the table, leaving out the group's quota keys."""
+        if k <= 1:
+            return self.single(first)
+        quota = self.quotas.get(group)
+        first = first.strip()
+        picks = [p for p in self.snapshot.sampler.draw(table, k, self.ctx)
+                 if p.strip() != first and not (quota and self.feasible.key(group, p) in quota)]
+        return (first, *picks[:k - 1])
+
+    def build_tree(self) -> Dict[str, List[Tuple[str, ...]]]:
+        """Nationality, Race and Sex columns in leaf order, with their Name column."""
+        constraint = self.feasible.constraint(self.selected_params)
+        leaves: Dict[tuple, Tuple[tuple, float]] = {}
+        for combination, key, weight in zip(self.feasible.combinations, self.feasible.keys, self.feasible.weights):
+            if all(fixed is None or value is None or fixed == value for fixed, value in zip(constraint, key)) \
+                    and self.feasible.named(combination):
+                leaves[key] = (combination, weight)
+        if not leaves:
+            raise ValueError(f"No NPC satisfies the selected parameters {self.selected_params}")
+        counts: Dict[tuple, int] = {(): self.size}
+        for depth, group in enumerate(self.TREE):
+            options: Dict[tuple, Dict[str, float]] = {parent: {} for parent in counts}
+            for key, (_, weight) in leaves.items():
+                choices = options.get(key[:depth])
+                if choices is not None:
+                    choices[key[depth]] = choices.get(key[depth], 0.0) + weight
+            counts = self.allocate(group, counts, options, self.quotas.get(group, {}))
+        snapshot = self.snapshot
+        sampler = snapshot.sampler
+        columns = {group: [] for group in self.TREE}
+        columns['Name'] = []
+        names = self.multiplicities('Name', 'Name' in self.selected_params) if 'Name' in snapshot.all_groups else None
+        races = self.multiplicities('Race', 'Race' in self.selected_params or snapshot.race_by_nationality) \
+            if 'Race' in snapshot.all_groups else None
+        race_tables: Dict[Optional[str], RarityTable] = {}
+        name_tables: Dict[Tuple[Optional[str], Tuple[str, ...]], RarityTable] = {}
+        for key, count in counts.items():
+            nationality, race, sex = leaves[key][0]
+            start = len(columns['Nationality'])
+            columns['Nationality'].extend([self.single(nationality) if nationality is not None else ()] * count)
+            columns['Sex'].extend([self.single(sex) if sex is not None else ()] * count)
+            leaf_races = self.single(race) if race is not None else ()
+            race_column = [leaf_races] * count
+            if race is not None and races is not None:
+                table = race_tables.get(nationality)
+                if table is None:
+                    entries = snapshot.races_for_nationality(nationality) \
+                        if snapshot.race_by_nationality and nationality is not None else snapshot.index.lookup('Race')
+                    table = race_tables[nationality] = sampler.table(entries)
+                for i in range(count):
+                    k = races[start + i]
+                    if k != 1:
+                        race_column[i] = self.fill('Race', table, race, k) if k else ()
+            columns['Race'].extend(race_column)
+            if names is None:
+                continue
+            sexes = [sex.replace(' ', '_')] if sex is not None else snapshot.extract_list(None, 'Sex')
+            leaf_table = None
+            for i, npc_races in enumerate(race_column):
+                if npc_races is leaf_races and leaf_table is not None:
+                    table = leaf_table
+                else:
+                    pool = tuple(r.replace(' ', '_') for r in npc_races) if npc_races else \
+                        tuple(snapshot.extract_list(None, 'Race'))
+                    table = name_tables.get((sex, pool))
+                    if table is None:
+                        table = name_tables[sex, pool] = sampler.table(snapshot.name_pool(sexes, list(pool)))
+                    if npc_races is leaf_races:
+                        leaf_table = table
+                k = names[start + i]
+                picks = sampler.draw(table, k, self.ctx) if k else []
+                if k and not picks:
+                    picks = [sampler.choice(table, self.ctx)] * k
+                columns['Name'].append(self.single(picks[0]) if k == 1 else tuple(picks))
+        if names is None:
+            del columns['Name']
+        order = list(range(self.size))
+        self.ctx.rng.shuffle(order)
+        return {group: [column[i] for i in order] for group, column in columns.items()}
+
+    def build_group(self, group: str) -> List[Tuple[str, ...]]:
+        """Column of a group outside Nationality, Race, Sex and Name."""
+        snapshot = self.snapshot
+        selected = self.selected_params.get(group)
+        sizes = self.multiplicities(group, selected is not None)
+        entries = snapshot.index.lookup(group)
+        if entries is None or entries.items == ('None',):
+            return [()] * self.size
+        table = snapshot.sampler.table(entries)
+        present = sum(1 for k in sizes if k)
+        if selected is not None and selected not in ('Any', 'None'):
+            firsts = [snapshot._resolve_param(group, unicodedata.normalize('NFC', selected))[0]] * present
+        else:
+            options: Dict[str, float] = {}
+            values: Dict[str, str] = {}
+            for base, chance in zip(table.bases, self.feasible.pick_probabilities(table.probabilities)):
+                key = self.feasible.key(group, base)
+                values.setdefault(key, base.strip())
+                options[key] = options.get(key, 0.0) + chance
+            counts = self.allocate(group, {(): present}, {(): options}, self.quotas.get(group, {}))
+            firsts = [values[key] for (key,), n in counts.items() for _ in range(n)]
+            self.ctx.rng.shuffle(firsts)
+        firsts = iter(firsts)
+        return [self.fill(group, table, next(firsts), k) if k else () for k in sizes]
+
+    def build(self) -> Population:
+        """Build every column; raises ValueError for quotas that cannot be met."""
+        groups = list(self.snapshot.all_groups)
+        unknown = set(self.quotas) - set(groups)
+        if unknown:
+            raise ValueError(f"Quotas for groups the database does not have: {', '.join(sorted(unknown))}")
+        if any(sum(quota.values()) > self.size for quota in self.quotas.values()):
+            raise ValueError(f"Quotas ask for more than {self.size} NPCs")
+        columns = self.build_tree()
+        for group in groups:
+            if group not in columns:
+                columns[group] = self.build_group(group)
+        return Population([group for group in groups if group in columns],
+                          {group: columns[group] for group in groups if group in columns})
+
+
+class KeySet:
+    """Exact set of uniqueness keys, kept as 64-bit blake2b hashes rather than the keys themselves."""
+
+    def __init__(self):
+        self.hashes: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    @staticmethod
+    def _hash(key: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+    def __contains__(self, key: bytes) -> bool:
+        return self._hash(key) in self.hashes
+
+    def add(self, key: bytes) -> bool:
+        """Add a key, returning False if it was already in the set."""
+        h = self._hash(key)
+        if h in self.hashes:
+            return False
+        self.hashes.add(h)
+        return True
+
+
+class BloomFilter:
+    """
+    Bloom filter of uniqueness keys sized for capacity keys at the given false positive rate, about 1.8 bytes a
+    key at 0.1%. A false positive makes a new key count as seen, so it is never let through twice.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(64, int(-max(capacity, 1) * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / max(capacity, 1) * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _positions(self, key: bytes) -> List[int]:
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key: bytes) -> bool:
+        """Add a key, returning False if it was (or looks) already added."""
+        new = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                self.bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+def seen_index(expected: int) -> Union[KeySet, BloomFilter]:
+    """Index of produced uniqueness keys for a run of expected NPCs: exact up to UNIQUE_EXACT_LIMIT, Bloom above."""
+    return KeySet() if expected <= UNIQUE_EXACT_LIMIT else BloomFilter(expected)
+
+
+class UniqueSpaceExhausted(ValueError):
+    """Raised when no NPC with an unused uniqueness key can be generated any more."""
+
+    def __init__(self, message: str, generated: int, exhausted: Set[Tuple[Tuple[str, ...], Tuple[str, ...]]]):
+        super().__init__(message)
+        self.generated = generated
+        self.exhausted = exhausted
+
+
+class UniqueFilter:
+    """
+    Lets an NPC through only if its key, the parameters of the key groups, was not produced before.
+    On a repeat that has Name in its key, the Name is redrawn from the NPC's name pool a few times, and then
+    from the names of the pool that are still unused, so a pool is used up to its last name without blind
+    retries. A Sex and Race combination without an unused name is recorded in exhausted.
+    """
+
+    def __init__(self, key_groups: Tuple[str, ...], seen: Union[KeySet, BloomFilter], retries: int = 8):
+        self.key_groups = tuple(key_groups)
+        self.seen = seen
+        self.retries = retries
+        self.exhausted: Set[Tuple[Tuple[str, ...], Tuple[str, ...]]] = set()
+
+    def key(self, npc_data: List[List[str]]) -> bytes:
+        """Key of an NPC: the cleaned parameters of every key group."""
+        params = {group[0]: group[1:] for group in npc_data}
+        return '\0'.join('\x1f'.join(clean_param(p) for p in params.get(group, ())) for group in
+                         self.key_groups).encode('utf-8')
+
+    @staticmethod
+    def combination(ctx: GenerationContext, npc_data: List[List[str]]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        """Sex and Race parameters the NPC's names are drawn for, as name_pool() takes them."""
+        params = {group[0]: group[1:] for group in npc_data}
+        sexes = [p for p in params.get('Sex', ()) if p] or ctx.snapshot.extract_list(None, 'Sex')
+        races = [p for p in params.get('Race', ()) if p] or ctx.snapshot.extract_list(None, 'Race')
+        return tuple(p.replace(' ', '_') for p in sexes), tuple(p.replace(' ', '_') for p in races)
+
+    def accept(self, ctx: GenerationContext, npc_data: List[List[str]]) -> Optional[List[List[str]]]:
+        """The NPC, with a redrawn Name if that makes it unique, or None if it is a repeat."""
+        if self.seen.add(self.key(npc_data)):
+            return npc_data
+        ctx.count('duplicates')
+        row = next((i for i, group in enumerate(npc_data) if group[0] == 'Name'), None)
+        if row is None or 'Name' not in self.key_groups:
+            return None
+        combination = self.combination(ctx, npc_data)
+        if combination in self.exhausted:
+            return None
+        sampler = ctx.snapshot.sampler
+        table = sampler.table(ctx.snapshot.name_pool(*map(list, combination)))
+        k = len(npc_data[row]) - 1
+        for _ in range(self.retries):
+            picks = sampler.draw(table, k, ctx)
+            if not picks:
+                break
+            npc_data[row] = ['Name', *picks]
+            if self.seen.add(self.key(npc_data)):
+                return npc_data
+        rest = npc_data[row][2:]
+        remaining = []
+        for base, p in zip(table.bases, table.probabilities):
+            if p > 0 and base != 'None':
+                npc_data[row] = ['Name', base, *[name for name in rest if name != base]]
+                if self.key(npc_data) not in self.seen:
+                    remaining.append((npc_data[row], p))
+        if not remaining:
+            self.exhausted.add(combination)
+            return None
+        npc_data[row] = ctx.rng.choices([names for names, _ in remaining], [p for _, p in remaining])[0]
+        self.seen.add(self.key(npc_data))
+        return npc_data
+
+
+SNAPSHOT_MAGIC = b'NPCSNAP\0'
+SNAPSHOT_FORMAT_VERSION = 5
+_SNAPSHOT_PREFIX = struct.Struct('<8sIQ')  # magic, format version, header length
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    """Resolve the generator's classes whether the snapshot was written by main.py run as a script or imported."""
+
+    def find_class(self, module: str, name: str):
+        if module in ('__main__', 'main') and name in globals():
+            return globals()[name]
+        return super().find_class(module, name)
+
+
+class SnapshotFile:
+    """
+    Compiled config and database in a single versioned binary file.
+    The file is a fixed prefix, a small pickled header and the pickled DatabaseSnapshot. The header lists every
+    source file with its mtime, size and SHA-256, so a stale snapshot is detected without parsing the sources,
+    and the snapshot itself is only unpickled, from a memory map, when it is first needed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def source_files(config_file: str, database_dir: str) -> List[str]:
+        """Every file a snapshot is compiled from: config.txt, the group files and the group subfolder files."""
+        files = [config_file]
+        for entry in sorted(os.listdir(database_dir)):
+            path = os.path.join(database_dir, entry)
+            if entry.endswith('.txt'):
+                files.append(path)
+            elif os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.txt'))
+        return files
+
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    def source_stats(cls, config_file: str, database_dir: str) -> Dict[str, Tuple[int, int]]:
+        """(mtime, size) of every source file, keyed by the same paths source_files lists."""
+        stat = os.stat(config_file)
+        stats = {config_file: (stat.st_mtime_ns, stat.st_size)}
+        with os.scandir(database_dir) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.name.endswith('.txt'):
+                    stat = entry.stat()
+                    stats[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                elif entry.is_dir():
+                    with os.scandir(entry.path) as sub_entries:
+                        for sub_entry in sub_entries:
+                            if sub_entry.name.endswith('.txt'):
+                                stat = sub_entry.stat()
+                                stats[sub_entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    @classmethod
+    def source_stamps(cls, config_file: str, database_dir: str) -> Dict[str, Tuple[int, int, str]]:
+        """(mtime, size, SHA-256) of every source file, keyed by path."""
+        stamps = {}
+        for path in cls.source_files(config_file, database_dir):
+            stat = os.stat(path)
+            stamps[path] = (stat.st_mtime_ns, stat.st_size, cls._file_hash(path))
+        return stamps
+
+    def write(self, snapshot: DatabaseSnapshot, config_file: str, database_dir: str) -> str:
+        """Write a snapshot compiled from config_file and database_dir, returning its id."""
+        body = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        snapshot_id = hashlib.sha256(body).hexdigest()
+        header = pickle.dumps({'id': snapshot_id, 'config_file': config_file, 'database_dir': database_dir,
+                               'sources': self.source_stamps(config_file, database_dir)},
+                              protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, len(header)))
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, self.path)
+        return snapshot_id
+
+    def read_header(self) -> Optional[dict]:
+        """Header of the snapshot file, or None if it is missing or written by another format version."""
+        try:
+            with open(self.path, 'rb') as f:
+                prefix = f.read(_SNAPSHOT_PREFIX.size)
+                if len(prefix) < _SNAPSHOT_PREFIX.size:
+                    return None
+                magic, version, header_length = _SNAPSHOT_PREFIX.unpack(prefix)
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+                    return None
+                return pickle.loads(f.read(header_length))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def fresh_id(self, config_file: str, database_dir: str) -> Optional[str]:
+        """
+        Id of the snapshot if it was compiled from the current sources, otherwise None.
+        Files whose mtime changed but whose content did not, e.g. after a checkout, still count as current.
+        """
+        header = self.read_header()
+        if header is None:
+            return None
+        sources = header['sources']
+        try:
+            paths = self.source_files(config_file, database_dir)
+        except OSError:
+            return None
+        if sorted(paths) != sorted(sources):
+            return None
+        for path in paths:
+            mtime, size, digest = sources[path]
+            stat = os.stat(path)
+            if stat.st_size != size:
+                return None
+            if stat.st_mtime_ns != mtime and self._file_hash(path) != digest:
+                return None
+        return header['id']
+
+    def load(self, expected_id: Optional[str] = None) -> DatabaseSnapshot:
+        """
+        Unpickle the snapshot straight from a read-only memory map, checking it is the one expected_id names.
+        The id is taken from the header, which a recompiled file replaces together with the body.
+        """
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, version, header_length = _SNAPSHOT_PREFIX.unpack_from(mapped)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+                raise ValueError(f"{self.path} is not a version {SNAPSHOT_FORMAT_VERSION} NPC snapshot.")
+            mapped.seek(_SNAPSHOT_PREFIX.size)
+            header = _SnapshotUnpickler(mapped).load()
+            if expected_id is not None and header['id'] != expected_id:
+                raise ValueError(f"{self.path} changed since it was validated.")
+            mapped.seek(_SNAPSHOT_PREFIX.size + header_length)
+            return _SnapshotUnpickler(mapped).load()
+
+
+def compile_snapshot(config_file: str, database_dir: str, snapshot_file: str) -> Tuple[DatabaseSnapshot, str]:
+    """Parse config_file and database_dir with the text loader and write them to snapshot_file."""
+    try:
+        with open(config_file, encoding='utf-8') as f:
+            config = f.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Config file {config_file} not found.")
+    snapshot = DatabaseSnapshot(config, DatabaseIndex(database_dir))
+    return snapshot, SnapshotFile(snapshot_file).write(snapshot, config_file, database_dir)
+
+
+class NPCGenerator:
+    """
+    Generates Non-Playable Characters (NPCs) based on configuration and database files.
+    The loaded data lives in an immutable DatabaseSnapshot and every call builds its NPC in its own
+    GenerationContext, so one generator can serve concurrent threads or asyncio tasks without locks.
+    With a snapshot_file the data comes from a compiled SnapshotFile instead of the text files: it is
+    recompiled first if config or database changed and otherwise only unpickled when first used.
+    reload() and watch() pick up edited files while the generator runs by swapping in a new snapshot.
+    Subgroup files (Name, Race and Sex subfolders) are read on first use and at most cache_bytes of them are kept.
+    """
+
+    def __init__(self, config_file: str = "./config.txt", database_dir: str = "./database",
+                 seed: Optional[int] = None, snapshot_file: Optional[str] = None,
+                 cache_bytes: Optional[int] = None):
+        """Initialize NPC generator with configuration and database folder, or a snapshot compiled from them."""
+        self.config_file = config_file
+        self.database_dir = database_dir
+        self.snapshot_file = snapshot_file
+        self.cache_bytes = cache_bytes
+        self.metrics: Optional[GenerationMetrics] = None
+        self.rng = random.Random(seed)
+        self._snapshot: Optional[DatabaseSnapshot] = None
+        self._snapshot_id: Optional[str] = None
+        self._snapshot_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._watcher: Optional[Tuple[threading.Thread, threading.Event]] = None
+        self._source_stats = SnapshotFile.source_stats(config_file, database_dir)
+        if snapshot_file is None:
+            self._snapshot = DatabaseSnapshot(self._load_config(config_file), self._load_database())
+        else:
+            self._snapshot_id = SnapshotFile(snapshot_file).fresh_id(config_file, database_dir)
+            if self._snapshot_id is None:
+                self._snapshot, self._snapshot_id = compile_snapshot(config_file, database_dir, snapshot_file)
+                self._bound_cache(self._snapshot)
+        self.seed(seed)
+
+    def __getattr__(self, name: str):
+        """Expose the snapshot's groups and rule tables as generator attributes."""
+        if name.startswith('_') or name == 'snapshot':
+            raise AttributeError(name)
+        return getattr(self.snapshot, name)
+
+    def __getstate__(self) -> dict:
+        """Pickle a snapshot backed generator without its data, workers load it from the snapshot file."""
+        state = self.__dict__.copy()
+        del state['_snapshot_lock'], state['_reload_lock']
+        state['_watcher'] = None
+        state['metrics'] = None
+        if self.snapshot_file is not None and self._snapshot_id is not None:
+            state['_snapshot'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._snapshot_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> DatabaseSnapshot:
+        """The loaded data, read from the snapshot file on first use."""
+        if self._snapshot is None:
+            with self._snapshot_lock:
+                if self._snapshot is None:
+                    self._snapshot = self._bound_cache(SnapshotFile(self.snapshot_file).load(self._snapshot_id))
+        return self._snapshot
+
+    def _bound_cache(self, snapshot: DatabaseSnapshot) -> DatabaseSnapshot:
+        if self.cache_bytes is not None:
+            snapshot.index.cache.resize(self.cache_bytes)
+        return snapshot
+
+    def reload(self) -> List[str]:
+        """
+        Re-read config and database files changed since the last load and swap in a new snapshot.
+        Only the changed files are parsed, and tables of untouched groups are carried over.
+        Generation calls already running finish on the snapshot they started with.
+        Returns the changed paths; if a changed file does not parse, the error is raised and nothing is swapped.
+        If the old snapshot's FeasibleSpace was in use, the new one is built on the reloading thread first.
+        """
+        with self._reload_lock:
+            stats = SnapshotFile.source_stats(self.config_file, self.database_dir)
+            changed = sorted(path for path in stats.keys() | self._source_stats.keys()
+                             if stats.get(path) != self._source_stats.get(path))
+            if not changed:
+                return []
+            old = self.snapshot
+            config = old.config
+            if self.config_file in changed:
+                config = self._load_config(self.config_file)
+            index, changed_groups = old.index.updated(path for path in changed if path != self.config_file)
+            snapshot = old.updated(config, index, changed_groups)
+            if old.feasible_built:
+                snapshot.feasible  # rebuilt here, before the swap, so readers of the new snapshot never build it
+            self._snapshot = snapshot
+            self._snapshot_id = None
+            self._source_stats = stats
+            return changed
+
+    def watch(self, interval: float = 1.0) -> None:
+        """Reload changed files every interval seconds on a daemon thread until stop_watching() is called."""
+        if self._watcher is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=self._watch, args=(interval, stop), name='npc-reload', daemon=True)
+        self._watcher = (thread, stop)
+        thread.start()
+
+    def stop_watching(self) -> None:
+        """Stop the thread started by watch()."""
+        if self._watcher is not None:
+            thread, stop = self._watcher
+            stop.set()
+            thread.join()
+            self._watcher = None
+
+    def _watch(self, interval: float, stop: threading.Event) -> None:
+        failed = None
+        while not stop.wait(interval):
+            try:
+                self.reload()
+                failed = None
+            except Exception as e:  # keep serving the last good snapshot until the files are fixed
+                if str(e) != failed:
+                    print(f"Reload failed, keeping the loaded database: {e}", file=sys.stderr)
+                    failed = str(e)
+
+    @staticmethod
+    def _load_config(config_file: str) -> str:
+        """Load configuration file."""
+        try:
+            with open(config_file, encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Config file {config_file} not found.")
+
+    def _load_database(self) -> DatabaseIndex:
+        """Load and index database files from directory."""
+        return DatabaseIndex(self.database_dir, SUBGROUP_CACHE_BYTES if self.cache_bytes is None
+                             else self.cache_bytes)
+
+    def extract_list(self, data: Optional[str], group_name: str, delimiter: Optional[str] = None) -> List[str]:
+        """Extract elements of a specific group from data string or file."""
+        return self.snapshot.extract_list(data, group_name, delimiter)
+
+    def instrument(self, enabled: bool = True) -> Optional[GenerationMetrics]:
+        """
+        Turn stage timers and draw counters on or off for the calls that follow; returns the GenerationMetrics.
+        Switched off, generation runs the plain GenerationContext and pays nothing for instrumentation.
+        """
+        if not enabled:
+            self.metrics = None
+        elif self.metrics is None:
+            self.metrics = GenerationMetrics()
+        return self.metrics
+
+    def export_metrics(self, output_format: str = 'prometheus') -> str:
+        """Metrics of an instrumented generator with the subgroup cache statistics, as 'prometheus' text or 'json'."""
+        if self.metrics is None:
+            raise ValueError("Generator is not instrumented, call instrument() first")
+        cache = self.snapshot.cache_stats()
+        if output_format == 'json':
+            return json.dumps(self.metrics.to_dict(cache), indent=2)
+        return self.metrics.to_prometheus(cache)
+
+    def _context(self, rng: Optional[random.Random] = None,
+                 snapshot: Optional[DatabaseSnapshot] = None) -> GenerationContext:
+        """Create the per-call context, using the generator's own stream unless an RNG is given."""
+        snapshot = snapshot or self.snapshot
+        rng = rng if rng is not None else self.rng
+        if self.metrics is not None:
+            return InstrumentedContext(self.metrics, snapshot, rng)
+        return GenerationContext(snapshot, rng)
+
+    def _rejected(self, snapshot: DatabaseSnapshot, selected_params: Dict[str, str]) -> None:
+        if self.metrics is not None:
+            self.metrics.reject(snapshot.invalid_groups(selected_params))
+
+    def generate(self, selected_params: Optional[Dict[str, str]] = None,
+                 rng: Optional[random.Random] = None, seed: Optional[int] = None) -> List[List[str]]:
+        """
+        Generate a new NPC, optionally with specific parameters for any group.
+        Pass an rng to draw from a caller-owned stream instead of the generator's own, or a seed to draw from a
+        fresh stream: the same seed, snapshot version and selected parameters always give the same NPC,
+        so storing the seed is enough to regenerate it (see replay()).
+        """
+        selected_params = selected_params or {}
+        ctx = self._context(random.Random(seed) if seed is not None else rng)
+        steps = ctx.snapshot.resolve_selected_params(selected_params)
+        if steps is None:
+            self._rejected(ctx.snapshot, selected_params)
+            return []
+        return ctx.generate(steps, selected_params)
+
+    def generate_constrained(self, selected_params: Optional[Dict[str, str]] = None,
+                             rng: Optional[random.Random] = None, seed: Optional[int] = None) -> List[List[str]]:
+        """
+        Generate an NPC whose Nationality, Race and Sex agree with each other and with the selected parameters.
+        One combination is drawn from the snapshot's FeasibleSpace and generated with those groups fixed, so a
+        rare combination costs one draw instead of retried generate() calls. Never returns an empty NPC: raises
+        ValueError if no combination satisfies the selected parameters (see count_feasible()).
+        """
+        selected_params = selected_params or {}
+        ctx = self._context(random.Random(seed) if seed is not None else rng)
+        drawn = ctx.snapshot.feasible.sample(selected_params, ctx.rng)
+        if drawn is None:
+            self._rejected(ctx.snapshot, selected_params)
+            raise ValueError(f"No NPC satisfies the selected parameters {selected_params}")
+        return ctx.generate(*drawn, fill_selected=True)
+
+    def count_feasible(self, selected_params: Optional[Dict[str, str]] = None) -> int:
+        """
+        Number of Nationality, Race and Sex combinations that satisfy the selected parameters, 0 if none does or
+        a selected parameter is not valid. After the first query for the same fixed groups this is a dict lookup.
+        """
+        return self.snapshot.feasible.count(selected_params or {})
+
+    def generate_unique(self, n: int, selected_params: Optional[Dict[str, str]] = None,
+                        key: Tuple[str, ...] = UNIQUE_KEY, rng: Optional[random.Random] = None,
+                        seed: Optional[int] = None, seen: Union[KeySet, BloomFilter, None] = None,
+                        max_attempts: int = 100) -> Iterator[List[List[str]]]:
+        """
+        Lazily generate n NPCs whose key groups, e.g. ('Name',) or ('Name', 'Race'), never repeat.
+        Produced keys are kept in seen, by default an exact KeySet, or a BloomFilter for runs above
+        UNIQUE_EXACT_LIMIT NPCs; pass the same seen to keep several runs unique together. A repeated Name is
+        redrawn from the unused names of its pool (see UniqueFilter). Raises UniqueSpaceExhausted, after the NPCs
+        produced so far, once max_attempts NPCs in a row were repeats, listing the used up Sex and Race name pools.
+        Raises ValueError right away if a key group is not a group of the database.
+        """
+        unknown = [group for group in key if group not in self.snapshot.all_groups]
+        if unknown or not key:
+            raise ValueError(f"Uniqueness key groups the database does not have: {', '.join(unknown)}" if unknown
+                             else "The uniqueness key needs at least one group")
+        return self._generate_unique(n, selected_params or {}, tuple(key), rng, seed, seen, max_attempts)
+
+    def _generate_unique(self, n: int, selected_params: Dict[str, str], key: Tuple[str, ...],
+                         rng: Optional[random.Random], seed: Optional[int], seen: Union[KeySet, BloomFilter, None],
+                         max_attempts: int) -> Iterator[List[List[str]]]:
+        ctx = self._context(random.Random(seed) if seed is not None else rng)
+        steps = ctx.snapshot.resolve_selected_params(selected_params)
+        if steps is None:
+            self._rejected(ctx.snapshot, selected_params)
+            return
+        unique = UniqueFilter(key, seen if seen is not None else seen_index(n))
+        for generated in range(n):
+            for _ in range(max_attempts):
+                npc_data = ctx.generate(steps, selected_params)
+                if npc_data and unique.accept(ctx, npc_data) is not None:
+                    yield npc_data
+                    break
+            else:
+                pools = ', '.join(' '.join(sexes + races).replace('_', ' ')
+                                  for sexes, races in sorted(unique.exhausted))
+                raise UniqueSpaceExhausted(
+                    f"No NPC with a new {'+'.join(key)} in {max_attempts} attempts after {generated} unique NPCs"
+                    + (f"; used up name pools: {pools}" if pools else ''), generated, unique.exhausted)
+
+    def generate_population(self, size: int, selected_params: Optional[Dict[str, str]] = None,
+                            quotas: Optional[Dict[str, Dict[str, int]]] = None, rng: Optional[random.Random] = None,
+                            seed: Optional[int] = None) -> Population:
+        """
+        Generate a whole population of size NPCs, such as the residents of one district given as the selected
+        Nationality, stored by column (see Population and PopulationBuilder).
+        Race, Sex and the other groups are apportioned up front so the mix follows the rarity weights instead of
+        the luck of size separate draws. quotas, e.g. {'Race': {'Human': 40}}, fix how many NPCs have a
+        parameter. Raises ValueError if the selected parameters have no feasible NPC or a quota cannot be met.
+        """
+        selected_params = selected_params or {}
+        ctx = self._context(random.Random(seed) if seed is not None else rng)
+        if ctx.snapshot.resolve_selected_params(selected_params) is None:
+            self._rejected(ctx.snapshot, selected_params)
+            raise ValueError(f"Selected parameters are not valid: {selected_params}")
+        return PopulationBuilder(ctx, size, selected_params, quotas or {}).build()
+
+    def generate_many(self, n: int, selected_params: Optional[Dict[str, str]] = None,
+                      rng: Optional[random.Random] = None, constrained: bool = False) -> Iterator[List[List[str]]]:
+        """
+        Lazily generate n NPCs that share the same selected parameters.
+        Parameters are validated and resolved once for the whole batch and the parsed config tables are reused,
+        so each NPC only pays for its own random draws. Yields nothing if the selected parameters are invalid.
+        With constrained, every NPC is drawn like generate_constrained() and nothing is yielded if no
+        combination is feasible.
+        Throughput target: 1.3x a loop of v.0.0.8 generate() calls with the same parameters. With every
+        group set to 'Any' on the bundled database this measured ~5000 NPCs/sec against ~200 NPCs/sec.
+        """
+        selected_params = selected_params or {}
+        ctx = self._context(rng)
+        if constrained:
+            feasible = ctx.snapshot.feasible
+            steps = feasible.resolve(selected_params)
+            if steps is None or not feasible.exists(selected_params):
+                self._rejected(ctx.snapshot, selected_params)
+                return
+            for _ in range(n):
+                yield ctx.generate(*feasible.sample(selected_params, ctx.rng, steps), fill_selected=True)
+            return
+        steps = ctx.snapshot.resolve_selected_params(selected_params)
+        if steps is None:
+            self._rejected(ctx.snapshot, selected_params)
+            return
+        for _ in range(n):
+            yield ctx.generate(steps, selected_params)
+
+    def generate_seeded(self, n: int, selected_params: Optional[Dict[str, str]] = None,
+                        seed: Optional[int] = None) -> Iterator[Tuple[int, List[List[str]]]]:
+        """
+        Lazily generate n NPCs as (npc_seed, npc) pairs, every NPC from its own 64-bit seed derived from seed.
+        Each pair satisfies npc == generate(selected_params, seed=npc_seed) on the same snapshot version, so a
+        batch can be kept as its seeds, or as seed and n, and single NPCs regenerated on demand.
+        """
+        selected_params = selected_params or {}
+        snapshot = self.snapshot
+        steps = snapshot.resolve_selected_params(selected_params)
+        if steps is None:
+            self._rejected(snapshot, selected_params)
+            return
+        master = random.Random(seed)
+        for _ in range(n):
+            npc_seed = master.getrandbits(64)
+            yield npc_seed, self._context(random.Random(npc_seed), snapshot=snapshot).generate(steps, selected_params)
+
+    def replay(self, seed: int, selected_params: Optional[Dict[str, str]] = None,
+               version: Optional[str] = None) -> List[List[str]]:
+        """
+        Regenerate the NPC that generate(selected_params, seed=seed) gave on snapshot version.
+        Raises ValueError if the loaded config or database differ from that version, as the NPC would differ too.
+        """
+        snapshot = self.snapshot
+        if version is not None and version != snapshot.version:
+            raise ValueError(f"NPC was generated from snapshot version {version}, "
+                             f"the loaded config and database are version {snapshot.version}")
+        selected_params = selected_params or {}
+        steps = snapshot.resolve_selected_params(selected_params)
+        if steps is None:
+            self._rejected(snapshot, selected_params)
+            return []
+        return self._context(random.Random(seed), snapshot=snapshot).generate(steps, selected_params)
+
+    def seed(self, seed: Optional[int] = None) -> None:
+        """Reseed the random stream of the generator; a fixed seed makes the following NPCs reproducible."""
+        self.rng.seed(seed)
+
+    def generate_parallel(self, n: int, selected_params: Optional[Dict[str, str]] = None,
+                          workers: Optional[int] = None, seed: Optional[int] = None,
+                          chunk_size: int = 256) -> Iterator[List[List[str]]]:
+        """
+        Generate n NPCs on a pool of worker processes, yielding them in order.
+        The work is split into chunks of chunk_size NPCs and every chunk gets its own RNG stream derived from
+        the master seed, so a fixed seed gives the same NPCs in the same order for any number of workers.
+        Workers inherit the loaded database through fork where available. Otherwise they receive a pickled copy,
+        or load it from the snapshot file when the generator has one.
+        At most two chunks per worker are in flight, so memory stays bounded however large n is.
+        An instrumented generator also collects the metrics of every chunk generated in a worker.
+        """
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        master = random.Random(seed)
+        tasks = ((master.getrandbits(64), min(chunk_size, n - start), chunk_size, selected_params)
+                 for start in range(0, n, chunk_size))
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or n <= chunk_size:
+            for task in tasks:
+                yield from self._generate_chunk(task)
+            return
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+        metrics = self.metrics
+        with context.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            pending = collections.deque()
+
+            def collect() -> List[List[List[str]]]:
+                if metrics is None:
+                    return pending.popleft().get()
+                chunk, values = pending.popleft().get()
+                metrics.merge(values)
+                return chunk
+
+            for task in tasks:
+                pending.append(pool.apply_async(
+                    _generate_worker_chunk if metrics is None else _generate_worker_chunk_metrics, (task,)))
+                if len(pending) >= workers * 2:
+                    yield from collect()
+            while pending:
+                yield from collect()
+
+    def _generate_chunk(self, task: Tuple[int, int, int, Optional[Dict[str, str]]]) -> List[List[List[str]]]:
+        """Generate one chunk of NPCs from its own seeded RNG stream."""
+        chunk_seed, count, chunk_size, selected_params = task
+        return list(self.generate_many(count, selected_params, rng=random.Random(chunk_seed)))
 
     def list_nationalities(self) -> List[str]:
         """List all possible nationalities from the database."""
         return self.extract_list(None, 'Nationality')
 
 
-def print_npc(npc_data: List[List[str]], print_output: bool = False, save: bool = False) -> str:
+_worker_generator: Optional[NPCGenerator] = None
+
+
+def _init_worker(npc_gen: NPCGenerator) -> None:
+    """Install the generator shared with a worker process."""
+    global _worker_generator
+    _worker_generator = npc_gen
+
+
+def _generate_worker_chunk(task: Tuple[int, int, int, Optional[Dict[str, str]]]) -> List[List[List[str]]]:
+    """Generate one chunk of NPCs inside a worker process."""
+    return _worker_generator._generate_chunk(task)
+
+
+def _generate_worker_chunk_metrics(task: Tuple[int, int, int, Optional[Dict[str, str]]]
+                                   ) -> Tuple[List[List[List[str]]], dict]:
+    """Generate one chunk of NPCs inside a worker process, returning it with the metrics of that chunk alone."""
+    saved = _worker_generator.metrics
+    metrics = _worker_generator.metrics = GenerationMetrics()
+    try:
+        return _worker_generator._generate_chunk(task), metrics.to_dict()
+    finally:
+        _worker_generator.metrics = saved
+
+
+@functools.lru_cache(maxsize=65536)
+def clean_param(param: str) -> str:
+    """Strip the rarity suffix and underscores from a parameter for display (see GroupEntries.displays)."""
+    return _display_form(param)
+
+
+def npc_to_dict(npc_data: List[List[str]]) -> Dict[str, List[str]]:
+    """Map every group of an NPC to its display-ready parameters, keeping group order."""
+    return {group[0]: [clean_param(param) for param in group[1:]] for group in npc_data}
+
+
+def write_npcs(npcs: Iterable[List[List[str]]], stream: TextIO, output_format: str = 'text',
+               groups: Optional[List[str]] = None, batch_size: int = 1024) -> int:
+    """
+    Write NPCs to a stream as 'text' (print_npc layout), 'jsonl' or 'csv', formatting batch_size NPCs
+    into one buffer per write. CSV columns are the given groups, with multiple parameters of a group joined by ', '.
+    Returns the number of NPCs written.
+    """
+    count = 0
+    if output_format == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=groups, restval='', extrasaction='ignore')
+        writer.writeheader()
+        for batch in _batched(npcs, batch_size):
+            writer.writerows([{group[0]: _text_params(tuple(group)) for group in npc} for npc in batch])
+            count += len(batch)
+        return count
+    encode = format_npc if output_format != 'jsonl' else format_json_npc
+    for batch in _batched(npcs, batch_size):
+        stream.write(''.join(map(encode, batch)))
+        count += len(batch)
+    return count
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+NPC_SEPARATOR = '-' * 120 + '\n'
+
+
+def format_npc(npc_data: List[List[str]]) -> str:
+    """One NPC in the print_npc layout, joined from the cached lines of its groups."""
     if not npc_data:
-        output_str = "No NPC data generated. Check parameter validity.\n" + '-' * 120 + '\n'
-    else:
-        max_group_length = max(len(group[0]) for group in npc_data) if npc_data else 10
-        output = []
-        for group in npc_data:
-            group_name = group[0]
-            params = group[1:]
-            params = [re.sub(r'\(\w{1,3}\)$', '', param).replace('_', ' ').strip() for param in params]
-            formatted_params = ', '.join(params)
-            output.append(f"{group_name:<{max_group_length}} : {formatted_params}")
-        output_str = '\n' + '\n'.join(output) + '\n' + '-' * 120 + '\n'
+        return "No NPC data generated. Check parameter validity.\n" + NPC_SEPARATOR
+    width = max([len(group[0]) for group in npc_data])
+    return '\n' + '\n'.join([_text_group(tuple(group), width) for group in npc_data]) + '\n' + NPC_SEPARATOR
+
+
+def format_json_npc(npc_data: List[List[str]]) -> str:
+    """One NPC as a JSON line, equal to json.dumps(npc_to_dict(...), ensure_ascii=False) plus a newline."""
+    return '{' + ', '.join([_json_group(tuple(group)) for group in npc_data]) + '}\n'
+
+
+_json_line = json.JSONEncoder(ensure_ascii=False).encode
+
+
+@functools.lru_cache(maxsize=65536)
+def _json_group(group: Tuple[str, ...]) -> str:
+    """JSON member of one NPC group as json.dumps(npc_to_dict(...)) writes it, cached for repeated groups."""
+    return _json_line(group[0]) + ': ' + _json_line([clean_param(param) for param in group[1:]])
+
+
+@functools.lru_cache(maxsize=65536)
+def _text_params(group: Tuple[str, ...]) -> str:
+    """Display parameters of one NPC group joined by ', ', cached for repeated groups."""
+    return ', '.join([clean_param(param) for param in group[1:]])
+
+
+@functools.lru_cache(maxsize=65536)
+def _text_group(group: Tuple[str, ...], width: int) -> str:
+    """Line of one NPC group in the print_npc layout, cached for repeated groups."""
+    return f"{group[0]:<{width}} : {_text_params(group)}"
+
+
+STORE_FORMATS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.db': 'sqlite', '.sqlite': 'sqlite', '.sqlite3': 'sqlite'}
+
+
+class NPCStore:
+    """
+    Buffered writer that appends saved NPCs to a file in batches as 'text' (print_npc layout, like save.txt),
+    'jsonl' or 'sqlite'; the format follows the file extension unless given.
+    Every batch goes out in one append (one transaction for SQLite) under a lock per file, shared by all stores
+    of the process and taken with flock across processes, so concurrent writers never interleave records.
+    SQLite saves index Nationality and Race and can be searched with query(), as can JSON Lines saves.
+    """
+
+    _file_locks: Dict[str, threading.Lock] = {}
+    _file_locks_guard = threading.Lock()
+
+    def __init__(self, path: str = './save.txt', output_format: Optional[str] = None, batch_size: int = 10000):
+        self.path = path
+        self.output_format = output_format or STORE_FORMATS.get(os.path.splitext(path)[1].lower(), 'text')
+        if self.output_format not in ('text', 'jsonl', 'sqlite'):
+            raise ValueError(f"Unknown save format '{self.output_format}'")
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer: list = []
+        self._buffer_lock = threading.Lock()
+        with NPCStore._file_locks_guard:
+            self._file_lock = NPCStore._file_locks.setdefault(os.path.abspath(path), threading.Lock())
+        self._connection = None
+        if self.output_format == 'sqlite':
+            self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            # WAL lets readers query while a writer appends; a batch is durable once its transaction commits
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("PRAGMA cache_size=-65536")
+            with self._file_lock, self._connection:
+                self._connection.execute("CREATE TABLE IF NOT EXISTS npcs (id INTEGER PRIMARY KEY, "
+                                         "nationality TEXT, race TEXT, npc TEXT NOT NULL)")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS npcs_nationality ON npcs (nationality, race)")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS npcs_race ON npcs (race)")
+
+    def __enter__(self) -> NPCStore:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _encode(self, npc_data: List[List[str]]):
+        if self.output_format == 'text':
+            return format_npc(npc_data)
+        line = format_json_npc(npc_data)
+        if self.output_format == 'jsonl':
+            return line
+        columns = {group[0]: _text_params(tuple(group)) for group in npc_data if group[0] in ('Nationality', 'Race')}
+        return columns.get('Nationality', ''), columns.get('Race', ''), line[:-1]
+
+    def add(self, npc_data: List[List[str]]) -> None:
+        """Buffer one NPC, writing the buffer out once it holds batch_size NPCs."""
+        record = self._encode(npc_data)
+        with self._buffer_lock:
+            self._buffer.append(record)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+            self._write(batch)
+
+    def extend(self, npcs: Iterable[List[List[str]]]) -> int:
+        """Buffer every NPC of an iterable, encoding a batch before taking the lock; returns how many were added."""
+        count = 0
+        records = []
+        encode = self._encode
+        for npc_data in npcs:
+            records.append(encode(npc_data))
+            if len(records) == self.batch_size:
+                count += self._add_records(records)
+                records = []
+        return count + self._add_records(records)
+
+    def _add_records(self, records: list) -> int:
+        with self._buffer_lock:
+            self._buffer.extend(records)
+            if len(self._buffer) >= self.batch_size:
+                batch, self._buffer = self._buffer, []
+                self._write(batch)
+        return len(records)
+
+    def flush(self) -> None:
+        """Write out all buffered NPCs."""
+        with self._buffer_lock:
+            batch, self._buffer = self._buffer, []
+            if batch:
+                self._write(batch)
+
+    def close(self) -> None:
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _write(self, batch: list) -> None:
+        with self._file_lock:
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.executemany("INSERT INTO npcs (nationality, race, npc) VALUES (?, ?, ?)", batch)
+            else:
+                data = ''.join(batch).encode('utf-8')
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                finally:
+                    os.close(fd)
+        self.count += len(batch)
+
+    def query(self, nationality: Optional[str] = None, race: Optional[str] = None,
+              limit: Optional[int] = None) -> Iterator[Dict[str, List[str]]]:
+        """Yield saved NPCs (as npc_to_dict gives them) with the given Nationality and/or Race, oldest first."""
+        self.flush()
+        nationality = clean_param(nationality) if nationality else None
+        race = clean_param(race) if race else None
+        if self.output_format == 'sqlite':
+            conditions, values = [], []
+            for column, value in (('nationality', nationality), ('race', race)):
+                if value:
+                    conditions.append(f"{column} = ?")
+                    values.append(value)
+            sql = "SELECT npc FROM npcs" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY id"
+            if limit is not None:
+                sql += f" LIMIT {int(limit)}"
+            for (line,) in self._connection.execute(sql, values):
+                yield json.loads(line)
+        elif self.output_format == 'jsonl':
+            if not os.path.exists(self.path) or limit == 0:
+                return
+            found = 0
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    npc = json.loads(line)
+                    if nationality and ', '.join(npc.get('Nationality', ())) != nationality:
+                        continue
+                    if race and ', '.join(npc.get('Race', ())) != race:
+                        continue
+                    yield npc
+                    found += 1
+                    if found == limit:
+                        return
+        else:
+            raise ValueError("Text saves cannot be queried, save as .jsonl or .db instead")
+
+
+def print_npc(npc_data: List[List[str]], print_output: bool = False, save: bool = False,
+              save_file: str = './save.txt') -> str:
+    output_str = format_npc(npc_data)
 
     if print_output:
         print(output_str)
-    if save:
-        with open('./save.txt', 'a', encoding='utf-8') as f:
-            f.write(output_str)
+    if save and npc_data:
+        with NPCStore(save_file) as store:
+            store.add(npc_data)
 
     return output_str
 
 
-def update_race_dropdown(npc_gen: NPCGenerator, group_vars: Dict[str, tk.StringVar], dropdowns: Dict[str, ttk.Combobox],
-                         *args) -> None:
-    nationality = group_vars['Nationality'].get()
-    if not nationality or nationality == 'Any':
-        params = npc_gen.extract_list(None, 'Race')
-        params = [re.sub(r'\(\w{1,3}\)$', '', p).strip() for p in params]
-        dropdowns['Race']['values'] = ['Any'] + params
-        dropdowns['Race'].set('Any')
-        return
+class DropdownValues:
+    """
+    Values of the GUI dropdowns, computed once per snapshot so that no Tk callback reads the database.
+    Races allowed for every nationality are worked out up front for the Nationality trace.
+    """
 
-    nationality_clean = unicodedata.normalize('NFC', nationality)
-    if nationality_clean.startswith('Resident of '):
-        nationality_clean = nationality_clean[len('Resident of '):]
-    nationality_clean = nationality_clean.replace(' ', '_')
-    race_file = os.path.join(npc_gen.database_dir, 'Race', f"Resident_of_{nationality_clean}Race.txt")
+    __slots__ = ('snapshot', 'groups', 'races')
 
-    try:
-        if os.path.exists(race_file):
-            with open(race_file, encoding='utf-8') as f:
-                races = f.read().strip().split('\n')
-                races = [unicodedata.normalize('NFC', re.sub(r'\(\w{1,3}\)$', '', race).strip()) for race in races if
-                         race.strip()]
-        else:
-            races = npc_gen.extract_list(None, 'Race')
-            races = [re.sub(r'\(\w{1,3}\)$', '', race).strip() for race in races]
-
-        dropdowns['Race']['values'] = ['Any'] + sorted(races)
-        if dropdowns['Race'].get() not in ['Any'] + races:
-            dropdowns['Race'].set('Any')
-    except (FileNotFoundError, IOError):
-        races = npc_gen.extract_list(None, 'Race')
-        races = [re.sub(r'\(\w{1,3}\)$', '', race).strip() for race in races]
-        dropdowns['Race']['values'] = ['Any'] + sorted(races)
+    def __init__(self, snapshot: DatabaseSnapshot, groups: Iterable[str]):
+        self.snapshot = snapshot
+        self.groups: Dict[str, List[str]] = {}
+        for group in groups:
+            entries = snapshot.index.lookup(group.replace(' ', '_'))
+            if entries is None:
+                params = ['None']
+            elif group in ['Nationality', 'Religion']:
+                params = list(entries.displays)
+            else:
+                params = [base.strip() for base in entries.bases]
+            self.groups[group] = ['Any'] + sorted(params)
+        self.races = {nationality: ['Any'] + sorted(snapshot.allowed_races(nationality))
+                      for nationality in self.groups.get('Nationality', ['Any'])[1:]}
+
+    def race_values(self, nationality: str) -> List[str]:
+        """Race dropdown values for the selected nationality, every race for 'Any'."""
+        if not nationality or nationality == 'Any':
+            return self.groups.get('Race', ['Any'])
+        values = self.races.get(nationality)
+        if values is None:
+            values = self.races[nationality] = ['Any'] + sorted(self.snapshot.allowed_races(nationality))
+        return values
+
+
+def dropdown_values(npc_gen: NPCGenerator, choices: List[DropdownValues]) -> DropdownValues:
+    """Dropdown values of the generator's current snapshot, recomputed once after a reload."""
+    if choices[0].snapshot is not npc_gen.snapshot:
+        choices[0] = DropdownValues(npc_gen.snapshot, choices[0].groups)
+    return choices[0]
+
+
+def update_race_dropdown(npc_gen: NPCGenerator, group_vars: Dict[str, tk.StringVar], dropdowns: Dict[str, ttk.Combobox],
+                         choices: List[DropdownValues], *args) -> None:
+    races = dropdown_values(npc_gen, choices).race_values(group_vars['Nationality'].get())
+    dropdowns['Race']['values'] = races
+    if dropdowns['Race'].get() not in races:
         dropdowns['Race'].set('Any')
 
 
-def generate_with_params(npc_gen: NPCGenerator, group_vars: Dict[str, tk.StringVar], dropdowns: Dict[str, ttk.Combobox],
-                         output_text: scrolledtext.ScrolledText, npc_data: List[List[List[str]]]) -> None:
-    """Generate an NPC with selected parameters and display it."""
+def selected_gui_params(npc_gen: NPCGenerator, group_vars: Dict[str, tk.StringVar],
+                        output_text: scrolledtext.ScrolledText) -> Optional[Dict[str, str]]:
+    """Selected parameters of the dropdowns, or None after showing why they cannot be generated."""
     selected_params = {group: var.get() for group, var in group_vars.items()}
+    snapshot = npc_gen.snapshot
     if selected_params.get('Nationality', 'Any') != 'Any' and selected_params.get('Race', 'Any') != 'Any':
-        nationality = selected_params['Nationality']
-        if nationality.startswith('Resident of '):
-            nationality = nationality[len('Resident of '):]
-        nationality = nationality.replace(' ', '_')
-        race_file = os.path.join(npc_gen.database_dir, 'Race', f"Resident_of_{nationality}Race.txt")
-        if os.path.exists(race_file):
-            with open(race_file, encoding='utf-8') as f:
-                valid_races = [unicodedata.normalize('NFC', re.sub(r'\(\w{1,3}\)$', '', race).strip()) for race in
-                               f.read().strip().split('\n')]
-            selected_race = re.sub(r'\(\w{1,3}\)$', '', selected_params['Race']).strip()
-            if selected_race not in valid_races:
-                output_text.delete(1.0, tk.END)
-                output_text.insert(tk.END,
-                                   f"Error: Race '{selected_race}' not valid for Nationality '{selected_params['Nationality']}'.\n" + '-' * 120 + '\n')
-                return
+        selected_race = snapshot.strip_rarity(selected_params['Race'])
+        if selected_race not in snapshot.allowed_races(selected_params['Nationality']):
+            output_text.delete(1.0, tk.END)
+            output_text.insert(tk.END,
+                               f"Error: Race '{selected_race}' not valid for Nationality '{selected_params['Nationality']}'.\n" + '-' * 120 + '\n')
+            return None
     if selected_params.get('Religion', 'Any') != 'Any':
-        valid_religions = npc_gen.extract_list(None, 'Religion')
-        valid_religions = [unicodedata.normalize('NFC', re.sub(r'\(\w{1,3}\)$', '', religion).strip()) for religion in
-                           valid_religions]
-        selected_religion = re.sub(r'\(\w{1,3}\)$', '', selected_params['Religion']).strip()
-        if selected_religion not in valid_religions:
+        if not snapshot.is_valid('Religion', selected_params['Religion']):
+            selected_religion = snapshot.strip_rarity(selected_params['Religion'])
             output_text.delete(1.0, tk.END)
             output_text.insert(tk.END,
                                f"Error: Religion '{selected_religion}' not found in database.\n" + '-' * 120 + '\n')
-            return
-    npc_data[0] = npc_gen.generate(selected_params)
+            return None
+    if not npc_gen.snapshot.feasible.exists(selected_params):
+        output_text.delete(1.0, tk.END)
+        output_text.insert(tk.END, "Error: no NPC can have the selected Nationality, Race and Sex together.\n" +
+                           '-' * 120 + '\n')
+        return None
+    return selected_params
+
+
+def generate_with_params(npc_gen: NPCGenerator, group_vars: Dict[str, tk.StringVar], dropdowns: Dict[str, ttk.Combobox],
+                         output_text: scrolledtext.ScrolledText, npc_data: List[List[List[str]]],
+                         batch: Optional[List[Optional[BatchJob]]] = None) -> None:
+    """Generate an NPC with selected parameters and display it, cancelling a running batch."""
+    if batch and batch[0] is not None:
+        batch[0].cancel()
+    selected_params = selected_gui_params(npc_gen, group_vars, output_text)
+    if selected_params is None:
+        return
+    npc_data[:] = [npc_gen.generate(selected_params)]
     output_text.delete(1.0, tk.END)
     output_text.insert(tk.END, print_npc(npc_data[0], print_output=False))
 
 
+class BatchJob:
+    """
+    Generates NPCs for the GUI on a daemon thread and hands them to the Tk main thread through a queue, in
+    chunks of chunk_size followed by None once the thread is done. cancel() stops it after the current NPC.
+    """
+
+    def __init__(self, npc_gen: NPCGenerator, count: int, selected_params: Dict[str, str],
+                 chunk_size: int = GUI_BATCH_CHUNK):
+        self.count = count
+        self.done = 0
+        self.error: Optional[Exception] = None
+        self.results: queue.Queue = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(npc_gen, selected_params, chunk_size),
+                                       name='npc-batch', daemon=True)
+        self.thread.start()
+
+    def _run(self, npc_gen: NPCGenerator, selected_params: Dict[str, str], chunk_size: int) -> None:
+        chunk = []
+        try:
+            for npc in npc_gen.generate_many(self.count, selected_params):
+                chunk.append(npc)
+                if self.cancelled.is_set():
+                    break
+                if len(chunk) >= chunk_size:
+                    self.results.put(chunk)
+                    chunk = []
+        except Exception as e:
+            self.error = e
+        finally:
+            if chunk:
+                self.results.put(chunk)
+            self.results.put(None)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+
+def generate_batch(root: tk.Tk, npc_gen: NPCGenerator, group_vars: Dict[str, tk.StringVar],
+                   output_text: scrolledtext.ScrolledText, npc_data: List[List[List[str]]],
+                   batch: List[Optional[BatchJob]], count_var: tk.StringVar, progress: ttk.Progressbar,
+                   status: tk.StringVar) -> None:
+    """Start generating the number of NPCs in count_var in the background, replacing a running batch."""
+    try:
+        count = int(count_var.get())
+    except ValueError:
+        count = 0
+    if count < 1:
+        status.set("Enter a number of NPCs to generate")
+        return
+    if batch[0] is not None:
+        batch[0].cancel()
+    selected_params = selected_gui_params(npc_gen, group_vars, output_text)
+    if selected_params is None:
+        return
+    job = batch[0] = BatchJob(npc_gen, count, selected_params)
+    npc_data[:] = []
+    output_text.delete(1.0, tk.END)
+    progress.configure(maximum=count, value=0)
+    status.set(f"0 / {count}")
+    root.after(GUI_POLL_MS, poll_batch, root, job, output_text, npc_data, batch, progress, status)
+
+
+def poll_batch(root: tk.Tk, job: BatchJob, output_text: scrolledtext.ScrolledText, npc_data: List[List[List[str]]],
+               batch: List[Optional[BatchJob]], progress: ttk.Progressbar, status: tk.StringVar) -> None:
+    """
+    Render the NPCs a BatchJob has queued since the last poll and schedule the next one until the job is done.
+    Only the first GUI_BATCH_SHOWN NPCs are written to the output, all of them are kept for Save NPC.
+    """
+    if batch[0] is not job:
+        return
+    finished = False
+    while True:
+        try:
+            chunk = job.results.get_nowait()
+        except queue.Empty:
+            break
+        if chunk is None:
+            finished = True
+            break
+        shown = max(0, GUI_BATCH_SHOWN - job.done)
+        if shown:
+            output_text.insert(tk.END, ''.join(map(format_npc, chunk[:shown])))
+        npc_data.extend(chunk)
+        job.done += len(chunk)
+    progress.configure(value=job.done)
+    note = f", showing the first {GUI_BATCH_SHOWN}" if job.done > GUI_BATCH_SHOWN else ''
+    if not finished:
+        status.set(f"{job.done} / {job.count}{note}")
+        root.after(GUI_POLL_MS, poll_batch, root, job, output_text, npc_data, batch, progress, status)
+        return
+    batch[0] = None
+    if job.error is not None:
+        status.set(f"Failed after {job.done} NPCs: {job.error}")
+    elif job.cancelled.is_set():
+        status.set(f"Cancelled after {job.done} of {job.count} NPCs{note}")
+    else:
+        status.set(f"Generated {job.done} NPCs{note}")
+
+
+def cancel_batch(batch: List[Optional[BatchJob]]) -> None:
+    """Stop a running batch; its NPCs generated so far stay in the output."""
+    if batch[0] is not None:
+        batch[0].cancel()
+
+
 def list_nationalities(npc_gen: NPCGenerator, output_text: scrolledtext.ScrolledText) -> None:
     """Display all available nationalities in the output text area."""
     output_text.delete(1.0, tk.END)
@@ -533,25 +2929,176 @@ def list_nationalities(npc_gen: NPCGenerator, output_text: scrolledtext.Scrolled
     output_text.insert(tk.END, '-' * 120 + '\n')
 
 
-def save_npc(npc_data: List[List[List[str]]], output_text: scrolledtext.ScrolledText) -> None:
-    """Save the current NPC data to a file and confirm in the output text area."""
-    if npc_data[0]:
-        print_npc(npc_data[0], save=True)
+def save_npc(npc_data: List[List[List[str]]], output_text: scrolledtext.ScrolledText,
+             save_file: str = './save.txt') -> None:
+    """Save the generated NPCs to a file and confirm in the output text area."""
+    npcs = [npc for npc in npc_data if npc]
+    if npcs:
+        with NPCStore(save_file) as store:
+            store.extend(npcs)
+        saved = "NPC data" if len(npcs) == 1 else f"{len(npcs)} NPCs"
         output_text.delete(1.0, tk.END)
-        output_text.insert(tk.END, "NPC data saved to save.txt\n" + '-' * 120 + '\n')
+        output_text.insert(tk.END, f"{saved} saved to {os.path.basename(save_file)}\n" + '-' * 120 + '\n')
     else:
         output_text.delete(1.0, tk.END)
         output_text.insert(tk.END, "No NPC data to save. Generate an NPC first.\n" + '-' * 120 + '\n')
 
 
-def main():
-    """Run the NPC generator with a Tkinter GUI."""
+SELECTABLE_GROUPS = ['Nationality', 'Race', 'Sex', 'Religion', 'Years']
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options; without --count the GUI is started."""
+    parser = argparse.ArgumentParser(description="NPC Generator")
+    parser.add_argument('--count', type=int, help="generate this many NPCs without the GUI")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes used with --count (0 uses every core)")
+    parser.add_argument('--seed', type=int, help="master seed that makes a --count run reproducible")
+    parser.add_argument('--format', choices=['text', 'jsonl', 'csv', 'sqlite'], default='text', dest='output_format',
+                        help="output format of generated NPCs, sqlite appends to the --output database "
+                             "(default: text)")
+    parser.add_argument('--output', help="file to write NPCs to instead of stdout")
+    parser.add_argument('--config', default="./config.txt", help="path to config.txt")
+    parser.add_argument('--database', default="./database", help="path to the database folder")
+    parser.add_argument('--snapshot', metavar='PATH',
+                        help="load config and database from this compiled snapshot, recompiling it when stale")
+    parser.add_argument('--save', default="./save.txt", metavar='PATH',
+                        help="file the GUI Save NPC button appends to, as JSON Lines for .jsonl and SQLite for "
+                             ".db (default: ./save.txt)")
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help="with the GUI, reload edited config and database files every SECONDS")
+    parser.add_argument('--cache-mb', type=float, metavar='MB',
+                        help="memory bound of the cache of subgroup files and name pools in MiB (default: 64)")
+    parser.add_argument('--population', action='store_true',
+                        help="with --count, generate the NPCs as one population with Race, Sex and the other groups "
+                             "apportioned up front by their weights")
+    parser.add_argument('--quota', action='append', default=[], metavar='GROUP=VALUE:COUNT',
+                        help="with --population, exact number of NPCs with a parameter, can be repeated")
+    parser.add_argument('--unique', metavar='GROUPS',
+                        help="with --count, never repeat the parameters of these comma separated groups together, "
+                             "e.g. Name,Race; runs in one process")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="with --count, write generation metrics to PATH, as JSON for .json and Prometheus text "
+                             "otherwise")
+    parser.add_argument('--compile', action='store_true',
+                        help="compile config and database into --snapshot (default: ./npc.snapshot) and exit")
+    for group in SELECTABLE_GROUPS:
+        parser.add_argument(f'--{group.lower()}', dest=group, metavar='VALUE',
+                            help=f"fixed {group} parameter, or 'Any' for a random one like in the GUI")
+    parser.add_argument('--param', action='append', default=[], metavar='GROUP=VALUE',
+                        help="fixed parameter for any other group, can be repeated")
+    return parser.parse_args(argv)
+
+
+def cache_bytes_from_args(args: argparse.Namespace) -> Optional[int]:
+    """Subgroup cache bound given with --cache-mb, or None for the default."""
+    return None if args.cache_mb is None else int(args.cache_mb * (1 << 20))
+
+
+def selected_params_from_args(args: argparse.Namespace) -> Dict[str, str]:
+    """Collect the selected parameters given on the command line."""
+    selected_params = {group: getattr(args, group) for group in SELECTABLE_GROUPS if getattr(args, group)}
+    for item in args.param:
+        group, sep, value = item.partition('=')
+        if not sep:
+            raise SystemExit(f"error: --param expects GROUP=VALUE, got '{item}'")
+        selected_params[group] = value
+    return selected_params
+
+
+def quotas_from_args(args: argparse.Namespace) -> Dict[str, Dict[str, int]]:
+    """Collect the population quotas given with --quota."""
+    quotas: Dict[str, Dict[str, int]] = {}
+    for item in args.quota:
+        group, sep, rest = item.partition('=')
+        value, sep2, count = rest.rpartition(':')
+        if not sep or not sep2 or not count.isdigit():
+            raise SystemExit(f"error: --quota expects GROUP=VALUE:COUNT, got '{item}'")
+        quotas.setdefault(group, {})[value] = int(count)
+    return quotas
+
+
+def unique_npcs(npc_gen: NPCGenerator, n: int, selected_params: Dict[str, str], key: Tuple[str, ...],
+                seed: Optional[int]) -> Iterator[List[List[str]]]:
+    """
+    NPCs of generate_unique(), stopping with a warning instead of an error once the key space is used up.
+    Unknown key groups raise ValueError before any NPC is generated.
+    """
+    npcs = npc_gen.generate_unique(n, selected_params, key, seed=seed)
+
+    def until_exhausted() -> Iterator[List[List[str]]]:
+        try:
+            yield from npcs
+        except UniqueSpaceExhausted as e:
+            print(f"warning: stopped after {e.generated} of {n} NPCs: {e}", file=sys.stderr)
+
+    return until_exhausted()
+
+
+def run_batch(args: argparse.Namespace) -> None:
+    """Generate args.count NPCs and stream them to stdout or args.output in args.output_format."""
+    npc_gen = NPCGenerator(args.config, args.database, snapshot_file=args.snapshot,
+                           cache_bytes=cache_bytes_from_args(args))
+    if args.metrics:
+        npc_gen.instrument()
+    selected_params = selected_params_from_args(args)
+    if npc_gen.snapshot.resolve_selected_params(selected_params) is None:
+        invalid = ', '.join(npc_gen.snapshot.invalid_groups(selected_params))
+        raise SystemExit(f"error: selected parameters are not valid for {invalid}: {selected_params}")
+    if args.output_format == 'sqlite' and not args.output:
+        raise SystemExit("error: --format sqlite needs an --output database file")
+    groups = npc_gen.all_groups + ([] if 'Nationality' in npc_gen.all_groups else ['Nationality'])
+    if args.population:
+        try:
+            npcs = npc_gen.generate_population(args.count, selected_params, quotas_from_args(args),
+                                               seed=args.seed).rows()
+        except ValueError as e:
+            raise SystemExit(f"error: {e}")
+    elif args.quota:
+        raise SystemExit("error: --quota needs --population")
+    elif args.unique:
+        try:
+            npcs = unique_npcs(npc_gen, args.count, selected_params,
+                               tuple(group.strip() for group in args.unique.split(',')), args.seed)
+        except ValueError as e:
+            raise SystemExit(f"error: {e}")
+    else:
+        npcs = npc_gen.generate_parallel(args.count, selected_params, workers=args.workers or None, seed=args.seed)
+    if args.output_format == 'sqlite':
+        with NPCStore(args.output, 'sqlite') as store:
+            store.extend(npcs)
+    elif args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            write_npcs(npcs, f, args.output_format, groups)
+    else:
+        write_npcs(npcs, sys.stdout, args.output_format, groups)
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            f.write(npc_gen.export_metrics('json' if args.metrics.endswith('.json') else 'prometheus'))
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run the NPC generator with a Tkinter GUI, or headless when --count is given."""
+    args = parse_args(argv)
+    if args.compile:
+        compile_snapshot(args.config, args.database, args.snapshot or "./npc.snapshot")
+        return
+    if args.count is not None:
+        run_batch(args)
+        return
+
     root = tk.Tk()
     root.title("NPC Generator v.0.0.8")
     root.geometry("800x600")
 
-    npc_gen = NPCGenerator()
-    npc_data: List[List[List[str]]] = [[]]
+    npc_gen = NPCGenerator(args.config, args.database, snapshot_file=args.snapshot,
+                           cache_bytes=cache_bytes_from_args(args))
+    if args.watch:
+        npc_gen.watch(args.watch)
+    # built off the Tk thread while the window comes up; reloads rebuild it on the watcher thread
+    threading.Thread(target=lambda: npc_gen.snapshot.feasible, name='npc-feasible', daemon=True).start()
+    npc_data: List[List[List[str]]] = []
+    batch: List[Optional[BatchJob]] = [None]
 
     control_frame = ttk.Frame(root, padding="10")
     control_frame.pack(fill=tk.X)
@@ -563,35 +3110,31 @@ def main():
     dropdowns = {}
     excluded_groups = ['Name', 'Personalities']
     display_groups = [g for g in npc_gen.all_groups if g not in excluded_groups and g != 'Years']
+    choices = [DropdownValues(npc_gen.snapshot,
+                              display_groups + (['Years'] if 'Years' in npc_gen.all_groups else []))]
 
     for i, group in enumerate(display_groups):
         label = ttk.Label(control_frame, text=f"{group}:")
         label.grid(row=i // 2, column=(i % 2) * 2, padx=5, pady=2, sticky=tk.E)
-        params = npc_gen.extract_list(None, group)
-        params = [unicodedata.normalize('NFC', re.sub(r'\(\w{1,3}\)$', '', p).strip()) for p in params]
-        if group in ['Nationality', 'Religion']:
-            params = [p.replace('_', ' ') for p in params]
-        params = ['Any'] + sorted(params)
         var = tk.StringVar(root)
         var.set('Any')
         group_vars[group] = var
-        dropdown = ttk.Combobox(control_frame, textvariable=var, values=params, state="readonly", width=30)
+        dropdown = ttk.Combobox(control_frame, textvariable=var, values=choices[0].groups[group], state="readonly",
+                                width=30)
         dropdown.grid(row=i // 2, column=(i % 2) * 2 + 1, padx=5, pady=2, sticky=tk.W)
         dropdowns[group] = dropdown
         if group == 'Nationality':
-            var.trace('w', lambda *args: update_race_dropdown(npc_gen, group_vars, dropdowns, *args))
+            var.trace('w', lambda *args: update_race_dropdown(npc_gen, group_vars, dropdowns, choices, *args))
 
     if 'Years' in npc_gen.all_groups:
         years_row = (len(display_groups) + 1) // 2
         label = ttk.Label(control_frame, text="Years:")
         label.grid(row=years_row, column=0, padx=5, pady=2, sticky=tk.E)
-        params = npc_gen.extract_list(None, 'Years')
-        params = [unicodedata.normalize('NFC', re.sub(r'\(\w{1,3}\)$', '', p).strip()) for p in params]
-        params = ['Any'] + sorted(params)
         var = tk.StringVar(root)
         var.set('Any')
         group_vars['Years'] = var
-        dropdown = ttk.Combobox(control_frame, textvariable=var, values=params, state="readonly", width=30)
+        dropdown = ttk.Combobox(control_frame, textvariable=var, values=choices[0].groups['Years'], state="readonly",
+                                width=30)
         dropdown.grid(row=years_row, column=1, padx=5, pady=2, sticky=tk.W)
         dropdowns['Years'] = dropdown
 
@@ -599,16 +3142,27 @@ def main():
     button_frame.grid(row=(len(display_groups) + 3) // 2, column=0, columnspan=4, pady=10)
 
     ttk.Button(button_frame, text="Generate",
-               command=lambda: generate_with_params(npc_gen, group_vars, dropdowns, output_text, npc_data)).grid(row=0,
-                                                                                                                 column=0,
-                                                                                                                 padx=5,
-                                                                                                                 pady=5)
+               command=lambda: generate_with_params(npc_gen, group_vars, dropdowns, output_text, npc_data,
+                                                    batch)).grid(row=0, column=0, padx=5, pady=5)
     ttk.Button(button_frame, text="List Nationalities", command=lambda: list_nationalities(npc_gen, output_text)).grid(
         row=0, column=1, padx=5, pady=5)
-    ttk.Button(button_frame, text="Save NPC", command=lambda: save_npc(npc_data, output_text)).grid(row=0, column=2,
-                                                                                                    padx=5, pady=5)
+    ttk.Button(button_frame, text="Save NPC", command=lambda: save_npc(npc_data, output_text, args.save)).grid(
+        row=0, column=2, padx=5, pady=5)
     ttk.Button(button_frame, text="Exit", command=root.quit).grid(row=0, column=3, padx=5, pady=5)
 
+    batch_frame = ttk.Frame(control_frame)
+    batch_frame.grid(row=(len(display_groups) + 5) // 2, column=0, columnspan=4, pady=(0, 5))
+    count_var = tk.StringVar(root, value='100')
+    status = tk.StringVar(root)
+    progress = ttk.Progressbar(batch_frame, length=200, mode='determinate')
+    ttk.Spinbox(batch_frame, from_=1, to=1_000_000, textvariable=count_var, width=9).grid(row=0, column=0, padx=5)
+    ttk.Button(batch_frame, text="Generate N",
+               command=lambda: generate_batch(root, npc_gen, group_vars, output_text, npc_data, batch, count_var,
+                                              progress, status)).grid(row=0, column=1, padx=5)
+    ttk.Button(batch_frame, text="Cancel", command=lambda: cancel_batch(batch)).grid(row=0, column=2, padx=5)
+    progress.grid(row=0, column=3, padx=5)
+    ttk.Label(batch_frame, textvariable=status, width=40).grid(row=0, column=4, padx=5, sticky=tk.W)
+
     root.mainloop()
 
 
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+"""
+NPC Generator HTTP service
+----------------------------------------
+Local asyncio HTTP/JSON service around one pre-loaded NPCGenerator (run with --help).
+
+POST /generate  {"selected_params": {"Race": "Human"}, "count": 10, "seed": 7}
+    Every field is optional. selected_params takes the same groups and values as NPCGenerator.generate().
+    Up to --chunk-size NPCs are answered as one JSON object {"seed": ..., "npcs": [...]}. Larger batches are
+    streamed as JSON Lines with chunked transfer encoding, one NPC per line; "stream": true or false forces
+    either form. A fixed seed gives the same NPCs as `main.py --count COUNT --seed SEED` with the same parameters.
+    Selections that no NPC can satisfy, like a Sex the selected Race never has, are refused with 400.
+POST /feasible  {"selected_params": {"Race": "Leshy"}} answers {"count": N}, the number of Nationality, Race and
+    Sex combinations an NPC with those parameters can have (NPCGenerator.count_feasible()); 0 means none.
+GET /health     snapshot version, loaded groups, subgroup cache statistics, pending requests and the settings.
+GET /metrics    with --metrics, stage timings, draw counters, refused selections by group and subgroup cache
+    statistics in the Prometheus text format, or as JSON with ?format=json.
+
+Generation runs in a process pool (a thread with --workers 0), at most two chunks per worker at a time, and a
+stream only asks for its next chunk once the client has taken the previous one. Requests beyond --max-pending
+are refused with 503, and a request taking longer than --timeout is answered with 504, or cut off if its
+stream has already started. The feasible combinations /generate and /feasible check against are worked out on a
+thread the first time they are needed, and on the --watch thread after a reload, never on the event loop.
+----------------------------------------
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+from typing import Dict, List, Optional, Tuple, AsyncIterator
+
+import main
+from main import NPCGenerator, npc_to_dict
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           503: 'Service Unavailable', 504: 'Gateway Timeout'}
+MAX_BODY = 1 << 20
+
+
+def _init_worker(npc_gen: NPCGenerator) -> None:
+    # Forked workers inherit the event loop's SIGTERM handler; restore the default so they can be stopped.
+    if sys.platform != 'win32':
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    main._init_worker(npc_gen)
+
+
+class HTTPError(Exception):
+    """Error answered to the client with the given status and a JSON error message."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Exchange:
+    """Response side of one HTTP request on a connection."""
+
+    __slots__ = ('writer', 'keep_alive', 'started')
+
+    def __init__(self, writer: asyncio.StreamWriter, keep_alive: bool):
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.started = False
+
+    def write_head(self, status: int, content_type: str, headers: Optional[List[Tuple[str, str]]] = None) -> None:
+        headers = [('Content-Type', content_type), ('Connection', 'keep-alive' if self.keep_alive else 'close')] + \
+                  (headers or [])
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers)
+        self.writer.write((head + '\r\n').encode('latin-1'))
+        self.started = True
+
+    def write_json(self, status: int, payload: dict, headers: Optional[List[Tuple[str, str]]] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.write_head(status, 'application/json', [('Content-Length', str(len(body)))] + (headers or []))
+        self.writer.write(body)
+
+    def write_chunk(self, data: bytes) -> None:
+        self.writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+
+class NPCService:
+    """Serves generation requests from one loaded NPCGenerator, with bounded executor work per worker."""
+
+    def __init__(self, npc_gen: NPCGenerator, workers: int, chunk_size: int = 256, max_pending: int = 64,
+                 max_count: int = 1_000_000, timeout: float = 30.0):
+        self.npc_gen = npc_gen
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.max_count = max_count
+        self.timeout = timeout
+        self.pending = 0
+        self.jobs = asyncio.Semaphore(max(workers, 1) * 2)
+        self.executor: Optional[concurrent.futures.Executor] = None
+        self.executor_snapshot = None
+        self.executor_users: Dict[concurrent.futures.Executor, int] = {}
+
+    def _executor(self) -> concurrent.futures.Executor:
+        """
+        Executor for the generator's current snapshot; after a reload a new process pool is started.
+        A replaced pool is shut down once the last stream using it has finished (see _acquire()).
+        """
+        if self.workers == 0:
+            if self.executor is None:
+                main._init_worker(self.npc_gen)
+                self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='npc')
+            return self.executor
+        snapshot = self.npc_gen.snapshot
+        if self.executor is None or snapshot is not self.executor_snapshot:
+            if self.executor is not None and not self.executor_users.get(self.executor):
+                self.executor.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=_init_worker, initargs=(self.npc_gen,))
+            self.executor_snapshot = snapshot
+        return self.executor
+
+    def _acquire(self) -> concurrent.futures.Executor:
+        """Current executor, kept running for the caller until _release() even if a reload replaces it."""
+        executor = self._executor()
+        self.executor_users[executor] = self.executor_users.get(executor, 0) + 1
+        return executor
+
+    def _release(self, executor: concurrent.futures.Executor) -> None:
+        users = self.executor_users.pop(executor) - 1
+        if users:
+            self.executor_users[executor] = users
+        elif executor is not self.executor:
+            executor.shutdown(wait=False)
+
+    def close(self) -> None:
+        for executor in (set(self.executor_users) | {self.executor}) - {None}:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def chunks(self, selected_params: Dict[str, str], count: int, seed: int) -> AsyncIterator[list]:
+        """Generate count NPCs chunk by chunk, with the next chunk already running while one is sent."""
+        loop = asyncio.get_running_loop()
+        executor = self._acquire()
+        master = random.Random(seed)
+        tasks = [(master.getrandbits(64), min(self.chunk_size, count - start), self.chunk_size, selected_params)
+                 for start in range(0, count, self.chunk_size)]
+
+        metrics = self.npc_gen.metrics if self.workers else None
+
+        async def run(task: Tuple[int, int, int, Dict[str, str]]) -> list:
+            async with self.jobs:
+                if metrics is None:
+                    return await loop.run_in_executor(executor, main._generate_worker_chunk, task)
+                chunk, values = await loop.run_in_executor(executor, main._generate_worker_chunk_metrics, task)
+                metrics.merge(values)
+                return chunk
+
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                pending.append(asyncio.ensure_future(run(task)))
+                if len(pending) >= 2:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+            self._release(executor)
+
+    @staticmethod
+    def parse_body(body: bytes) -> Tuple[dict, Dict[str, str]]:
+        """Decode a JSON request body, returning it with its validated selected_params."""
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError as e:
+            raise HTTPError(400, f"body is not valid JSON: {e}")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "body must be a JSON object")
+        selected_params = request.get('selected_params') or {}
+        if not isinstance(selected_params, dict) or not all(
+                isinstance(k, str) and isinstance(v, str) for k, v in selected_params.items()):
+            raise HTTPError(400, "selected_params must map group names to parameter strings")
+        return request, selected_params
+
+    def parse_request(self, body: bytes) -> Tuple[Dict[str, str], int, int, Optional[bool]]:
+        """Validate a /generate body, returning (selected params, count, seed, stream)."""
+        request, selected_params = self.parse_body(body)
+        count = request.get('count', 1)
+        if not isinstance(count, int) or isinstance(count, bool) or not 0 < count <= self.max_count:
+            raise HTTPError(400, f"count must be an integer from 1 to {self.max_count}")
+        seed = request.get('seed')
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        elif not isinstance(seed, int) or isinstance(seed, bool):
+            raise HTTPError(400, "seed must be an integer")
+        stream = request.get('stream')
+        if stream is not None and not isinstance(stream, bool):
+            raise HTTPError(400, "stream must be true or false")
+        snapshot = self.npc_gen.snapshot
+        if snapshot.resolve_selected_params(selected_params) is None:
+            self.npc_gen._rejected(snapshot, selected_params)
+            raise HTTPError(400, f"selected parameters are not valid: {selected_params}")
+        return selected_params, count, seed, stream
+
+    async def feasible(self) -> main.FeasibleSpace:
+        """FeasibleSpace of the current snapshot, built on a thread if it is not yet so the loop keeps serving."""
+        snapshot = self.npc_gen.snapshot
+        if not snapshot.feasible_built:
+            await asyncio.get_running_loop().run_in_executor(None, lambda: snapshot.feasible)
+        return snapshot.feasible
+
+    async def generate(self, body: bytes, exchange: Exchange) -> None:
+        selected_params, count, seed, stream = self.parse_request(body)
+        if not (await self.feasible()).exists(selected_params):
+            raise HTTPError(400, f"no NPC can have the selected Nationality, Race and Sex together: {selected_params}")
+        if stream is None:
+            stream = count > self.chunk_size
+        chunks = self.chunks(selected_params, count, seed)
+        try:
+            if not stream:
+                npcs = []
+                async for chunk in chunks:
+                    npcs.extend(npc_to_dict(npc) for npc in chunk)
+                exchange.write_json(200, {'seed': seed, 'npcs': npcs})
+                return
+            started = False
+            async for chunk in chunks:
+                if not started:
+                    exchange.write_head(200, 'application/x-ndjson', [('Transfer-Encoding', 'chunked'),
+                                                                      ('X-Seed', str(seed))])
+                    started = True
+                exchange.write_chunk(''.join(json.dumps(npc_to_dict(npc), ensure_ascii=False) + '\n'
+                                             for npc in chunk).encode())
+                await exchange.writer.drain()
+            exchange.write_chunk(b'')
+        finally:
+            await chunks.aclose()  # releases the executor right away when the client is gone or the request timed out
+
+    def health(self) -> dict:
+        snapshot = self.npc_gen.snapshot
+        return {'status': 'ok', 'version': snapshot.version, 'groups': snapshot.all_groups,
+                'cache': snapshot.cache_stats(), 'pending': self.pending, 'max_pending': self.max_pending,
+                'workers': self.workers, 'chunk_size': self.chunk_size, 'timeout': self.timeout}
+
+    def metrics(self, query: str, exchange: Exchange) -> None:
+        if self.npc_gen.metrics is None:
+            raise HTTPError(404, "metrics are not collected, start the server with --metrics")
+        if 'format=json' in query.split('&'):
+            exchange.write_json(200, json.loads(self.npc_gen.export_metrics('json')))
+            return
+        body = self.npc_gen.export_metrics().encode()
+        exchange.write_head(200, 'text/plain; version=0.0.4; charset=utf-8', [('Content-Length', str(len(body)))])
+        exchange.writer.write(body)
+
+    async def dispatch(self, method: str, path: str, body: bytes, exchange: Exchange) -> bool:
+        """Answer one request; returns False if the connection has to be closed afterwards."""
+        path, _, query = path.partition('?')
+        try:
+            if path == '/health':
+                if method != 'GET':
+                    raise HTTPError(405, "use GET /health")
+                exchange.write_json(200, self.health())
+                return True
+            if path == '/metrics':
+                if method != 'GET':
+                    raise HTTPError(405, "use GET /metrics")
+                self.metrics(query, exchange)
+                return True
+            if path == '/feasible':
+                if method != 'POST':
+                    raise HTTPError(405, "use POST /feasible")
+                selected_params = self.parse_body(body)[1]
+                feasible = await self.feasible()
+                count = await asyncio.get_running_loop().run_in_executor(None, feasible.count, selected_params)
+                exchange.write_json(200, {'count': count})
+                return True
+            if path != '/generate':
+                raise HTTPError(404, f"no such endpoint: {path}")
+            if method != 'POST':
+                raise HTTPError(405, "use POST /generate")
+            if self.pending >= self.max_pending:
+                exchange.write_json(503, {'error': "too many pending requests"}, [('Retry-After', '1')])
+                return True
+            self.pending += 1
+            try:
+                await asyncio.wait_for(self.generate(body, exchange), self.timeout)
+            finally:
+                self.pending -= 1
+        except HTTPError as e:
+            exchange.write_json(e.status, {'error': str(e)})
+        except asyncio.TimeoutError:
+            if not exchange.started:
+                exchange.keep_alive = False
+                exchange.write_json(504, {'error': f"request took longer than {self.timeout} s"})
+            return False
+        return True
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve HTTP/1.1 requests on one connection until the client closes it or asks not to keep it alive."""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), self.timeout)
+                except HTTPError as e:
+                    Exchange(writer, False).write_json(e.status, {'error': str(e)})
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                exchange = Exchange(writer, headers.get('connection', '').lower() != 'close')
+                if not await self.dispatch(method, path, body, exchange) or not exchange.keep_alive:
+                    break
+                await writer.drain()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """Read one HTTP/1.1 request, or return None if the client closed the connection."""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HTTPError(400, "malformed Content-Length")
+    if length > MAX_BODY:
+        raise HTTPError(413, f"body larger than {MAX_BODY} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+async def serve(args: argparse.Namespace) -> None:
+    """Load the generator once and serve it until interrupted."""
+    npc_gen = NPCGenerator(args.config, args.database, snapshot_file=args.snapshot,
+                           cache_bytes=main.cache_bytes_from_args(args))
+    if args.watch:
+        npc_gen.watch(args.watch)
+    if args.metrics:
+        npc_gen.instrument()
+    workers = (os.cpu_count() or 1) if args.workers is None else args.workers
+    service = NPCService(npc_gen, workers, args.chunk_size, args.max_pending, args.max_count, args.timeout)
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    host, port = server.sockets[0].getsockname()[:2]
+    print(f"Serving NPCs on http://{host}:{port}", file=sys.stderr, flush=True)
+    stop = asyncio.Event()
+    if sys.platform != 'win32':
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        service.close()
+        npc_gen.stop_watching()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse service options."""
+    parser = argparse.ArgumentParser(description="NPC Generator HTTP service")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8080, help="port to listen on, 0 picks a free one")
+    parser.add_argument('--workers', type=int, help="generation processes, 0 generates in a thread "
+                                                    "(default: one per core)")
+    parser.add_argument('--chunk-size', type=int, default=256, help="NPCs per executor job and streamed chunk")
+    parser.add_argument('--max-pending', type=int, default=64, help="requests in progress before answering 503")
+    parser.add_argument('--max-count', type=int, default=1_000_000, help="largest count one request may ask for")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds a request may take (default: 30)")
+    parser.add_argument('--config', default="./config.txt", help="path to config.txt")
+    parser.add_argument('--database', default="./database", help="path to the database folder")
+    parser.add_argument('--snapshot', metavar='PATH', help="load config and database from this compiled snapshot")
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help="reload edited files every SECONDS")
+    parser.add_argument('--cache-mb', type=float, metavar='MB', help="subgroup cache bound in MiB (default: 64)")
+    parser.add_argument('--metrics', action='store_true', help="collect generation metrics served on GET /metrics")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,85 @@
+"""Constrained generation from the FeasibleSpace of the bundled database."""
+import collections
+import math
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+
+class FeasibleSpaceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.npc_gen = main.NPCGenerator(os.path.join(ROOT, 'config.txt'), os.path.join(ROOT, 'database'))
+        cls.feasible = cls.npc_gen.snapshot.feasible
+
+    def test_every_combination_generates(self):
+        ctx = self.npc_gen._context(random.Random(1))
+        for combination in self.feasible.combinations:
+            npc = ctx.generate(*self.feasible.fix(combination, [], {}), fill_selected=True)
+            self.assertTrue(npc, combination)
+            rows = {group[0]: group[1:] for group in npc}
+            for group, param in zip(self.feasible.GROUPS, combination):
+                if param is not None:
+                    self.assertEqual(rows[group][0], param, combination)
+
+    def test_count_agrees_with_space(self):
+        race = next(race for _, race, _ in self.feasible.combinations if race and ' ' in race)
+        self.assertGreater(self.npc_gen.count_feasible({'Race': race}), 0)
+        self.assertEqual(self.npc_gen.count_feasible({'Race': 'Nope'}), 0)
+        with self.assertRaises(ValueError):
+            self.npc_gen.generate_constrained({'Race': 'Nope'})
+
+    def test_constrained_keeps_race_multiplicity(self):
+        rng = random.Random(2)
+        multiple = 0
+        for npc in self.npc_gen.generate_many(2000, rng=rng, constrained=True):
+            race = next(group[1:] for group in npc if group[0] == 'Race')
+            self.assertNotIn('', race)
+            self.assertEqual(len(set(race)), len(race))
+            multiple += len(race) > 1
+        # Race_by_10_min1max2 adds a second race to about one NPC in ten
+        self.assertGreater(multiple, 100)
+
+    def test_constrained_marginals_match_generate(self):
+        n = 3000
+        for selected_params in ({}, {'Race': 'Lizardfolk'}, {'Race': 'Leshy'}, {'Race': 'Android'}):
+            plain, constrained = collections.Counter(), collections.Counter()
+            rng = random.Random(3)
+            for _ in range(n):
+                plain.update(self.sex_and_race(self.npc_gen.generate(selected_params, rng=rng)))
+            for npc in self.npc_gen.generate_many(n, selected_params, rng=random.Random(4), constrained=True):
+                constrained.update(self.sex_and_race(npc))
+            for key in plain.keys() | constrained.keys():
+                p, q = plain[key] / n, constrained[key] / n
+                spread = math.sqrt(max(p * (1 - p), q * (1 - q), 1 / n) * 2 / n)
+                self.assertLess(abs(p - q), 5 * spread, (selected_params, key, plain[key], constrained[key]))
+
+    def test_population_marginals_match_generate_many(self):
+        n = 3000
+        for selected_params in ({}, {'Race': 'Lizardfolk'}, {'Race': 'Android'}):
+            plain = collections.Counter()
+            for npc in self.npc_gen.generate_many(n, selected_params, rng=random.Random(5)):
+                plain.update(self.sex_and_race(npc))
+            population = collections.Counter()
+            for npc in self.npc_gen.generate_population(n, selected_params, seed=6).rows():
+                population.update(self.sex_and_race(npc))
+            for key in plain.keys() | population.keys():
+                p, q = plain[key] / n, population[key] / n
+                spread = math.sqrt(max(p * (1 - p), q * (1 - q), 1 / n) / n)
+                self.assertLess(abs(p - q), 5 * spread, (selected_params, key, plain[key], population[key]))
+
+    @staticmethod
+    def sex_and_race(npc: list) -> list:
+        rows = {group[0]: group[1:] for group in npc}
+        return [('Sex', rows['Sex'][0]), ('Race', rows['Race'][0])]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""RaritySampler.draw against the filter-then-choose pipeline it replaced."""
+import collections
+import math
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+RARITY_CLASSES = {'S': 100, 'C': 80, 'U': 50, 'R': 30, 'M': 10, 'N': 0}
+ITEMS = ('Alpha(S)', 'Beta(C)', 'Gamma(U)', 'Delta(R)', 'Epsilon(M)', 'Zeta(N)', 'Eta(65)', 'Theta')
+DRAWS = 60000
+
+
+def reference_draw(table: main.RarityTable, k: int, rng: random.Random) -> list:
+    """The old pipeline: filter the list by rarity, then pick k distinct survivors, repeating once all are used."""
+    active = [base for base, p in zip(table.bases, table.probabilities) if p >= rng.randint(1, 100) / 100]
+    picks, used = [], []
+    for _ in range(k):
+        if not active:
+            break
+        index = rng.randint(0, len(active) - 1)
+        while index in used and len(used) < len(active):
+            index = rng.randint(0, len(active) - 1)
+        used.append(index)
+        picks.append(active[index])
+    return picks
+
+
+class RaritySamplerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.table = main.RaritySampler(RARITY_CLASSES).table(ITEMS)
+
+    def frequencies(self, draw, k: int, seed: int) -> collections.Counter:
+        """Frequency of every (slot, parameter) pair, with (slot, None) for slots left empty."""
+        rng = random.Random(seed)
+        counts = collections.Counter()
+        for _ in range(DRAWS):
+            picks = draw(rng)
+            for slot in range(k):
+                counts[slot, picks[slot] if slot < len(picks) else None] += 1
+        return counts
+
+    def assert_same_distribution(self, k: int) -> None:
+        ctx = main.GenerationContext(None, random.Random())
+
+        def sampled(rng: random.Random) -> list:
+            ctx.rng = rng
+            return main.RaritySampler.draw(self.table, k, ctx)
+
+        drawn = self.frequencies(sampled, k, seed=k)
+        expected = self.frequencies(lambda rng: reference_draw(self.table, k, rng), k, seed=1000 + k)
+        for key in drawn.keys() | expected.keys():
+            p = (drawn[key] + expected[key]) / (2 * DRAWS)
+            error = math.sqrt(max(p * (1 - p), 1 / DRAWS) * 2 / DRAWS)
+            self.assertLessEqual(abs(drawn[key] - expected[key]) / DRAWS, 5 * error, (k, key))
+
+    def test_single_pick(self):
+        self.assert_same_distribution(1)
+
+    def test_several_picks(self):
+        self.assert_same_distribution(3)
+
+    def test_picks_near_pool_size(self):
+        self.assert_same_distribution(6)
+
+    def test_more_picks_than_parameters(self):
+        self.assert_same_distribution(10)
+
+    def test_zero_rarity_never_drawn(self):
+        ctx = main.GenerationContext(None, random.Random(3))
+        for _ in range(2000):
+            self.assertNotIn('Zeta', main.RaritySampler.draw(self.table, 8, ctx))
+
+    def test_distinct_until_survivors_run_out(self):
+        ctx = main.GenerationContext(None, random.Random(4))
+        for _ in range(2000):
+            picks = main.RaritySampler.draw(self.table, 10, ctx)
+            survivors = len(set(picks))
+            self.assertEqual(len(set(picks[:survivors])), survivors)
+
+
+if __name__ == '__main__':
+    unittest.main()